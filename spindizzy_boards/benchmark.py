@@ -0,0 +1,150 @@
+"""
+Times the download and serving pipeline against a local fake MUCK
+so performance changes can be measured without SpinDizzy.
+
+e.g. `python benchmark.py --sizes 10,1000,100000`
+
+For each size it downloads that many posts, spread over a few boards,
+with ``MuckDownloader``, publishes them the way the web app does and
+then requests each kind of page. Pages that are cached after the first
+request report both the first and the median of the repeats.
+"""
+from typing import Callable, Dict, List
+import argparse
+import logging
+import os
+import statistics
+import tempfile
+import time
+
+from pyramid.request import Request
+
+from board_content import Post
+from fake_muck_server import FakeMuck, FakeMuckServer
+from muck_downloader import MuckDownloader
+from snapshot import SnapshotStore
+from spindizzy_boards import make_wsgi_app, SpinDizzyBoards
+
+
+_BOARDS = [['+read', 'General Board'], ['cread', 'Commands Board'], ['rpread', 'Role-Playing Board']]
+
+
+def _timed(function: Callable):
+    """Returns how long ``function`` took to run in seconds and what it returned."""
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+class Benchmark(object):
+    """Runs every step for one size and collects how long each took."""
+    def __init__(self, posts: int, latency: float, repeat: int, batch_names: bool):
+        """
+        Args:
+            posts (int): How many posts to spread over the boards.
+            latency (float): Seconds the fake MUCK waits before each reply.
+            repeat (int): How many times to repeat the requests that are cached.
+            batch_names (bool): Whether to look up names with ``getnames``
+                instead of one ``getname`` per dbref.
+        """
+        self.posts = posts
+        self.repeat = repeat
+        self.batch_names = batch_names
+        per_board = {board: posts // len(_BOARDS) + (1 if i < posts % len(_BOARDS) else 0)
+                     for i, (board, name) in enumerate(_BOARDS)}
+        self.muck = FakeMuck(per_board)
+        self.server = FakeMuckServer(self.muck, latency=latency)
+        self.results = []  # (step, seconds) pairs.
+
+    def _record(self, step: str, seconds: float):
+        self.results.append((step, seconds))
+        logging.info("{posts:>7} posts  {step:<32} {seconds:9.4f}s"
+                     .format(posts=self.posts, step=step, seconds=seconds))
+
+    def _request(self, app, step: str, path: str):
+        first, response = _timed(lambda: Request.blank(path).get_response(app))
+        if response.status_code != 200:
+            raise RuntimeError("{path} returned {status}".format(path=path, status=response.status))
+        self._record(step + " (first)", first)
+        repeats = [_timed(lambda: Request.blank(path).get_response(app))[0] for _ in range(self.repeat)]
+        if repeats:
+            self._record(step + " (median)", statistics.median(repeats))
+
+    def run(self) -> List:
+        self.server.start()
+        host, port = self.server.address
+        downloader = MuckDownloader(host=host, port=port, ssl=False, character='bench', password='bench',
+                                    get_posts_command='process_posts', get_name_command='getname',
+                                    get_names_command='getnames' if self.batch_names else None,
+                                    boards=_BOARDS, board_timeout=3600)
+        try:
+            seconds, content = _timed(downloader.get_posts)
+            self._record("MuckDownloader.get_posts", seconds)
+            since = {board: max(posts, default=0) for board, posts in content.items()}
+            self._record("MuckDownloader.get_updates", _timed(lambda: downloader.get_updates(since))[0])
+        finally:
+            downloader.close()
+            self.server.stop()
+
+        with tempfile.TemporaryDirectory() as directory:
+            config = {'interval': 300,
+                      'timezone': 'US/Pacific',
+                      'fake_muck': False,
+                      'snapshot_file': os.path.join(directory, 'snapshot.json'),
+                      'muck': {'boards': _BOARDS},
+                      'web': {'url_base': 'http://localhost:7000', 'feed_domain': 'localhost',
+                              'feed_max_entries': 50, 'posts_per_page': 50}}
+            self._record("SnapshotStore.save",
+                         _timed(lambda: SnapshotStore(config['snapshot_file']).save(content))[0])
+            # Loading the snapshot publishes it: indexes, feeds and search from scratch.
+            seconds, worker = _timed(lambda: SpinDizzyBoards(config, fetch=False))
+            self._record("load and publish", seconds)
+
+        # One new post on one board, like a typical refresh. Start from the content being
+        # served, not the downloaded copy: caches recognize unchanged posts by identity,
+        # so from the downloaded copy every post would look new and this would time a full rebuild.
+        content = worker.current_content
+        new_content = dict(content)
+        new_content['+read'] = dict(content['+read'])
+        post = Post(time=max(max(posts, default=0) for posts in content.values()) + 1,
+                    owner='#1', owner_name='Bench', title='Bench', content='Bench\n')
+        new_content['+read'][post.time] = post
+        self._record("publish one new post", _timed(lambda: worker._publish(new_content))[0])
+        self._record("_construct_feeds (unchanged)", _timed(worker._construct_feeds)[0])
+
+        app = make_wsgi_app(worker)
+        oldest = min(new_content['+read'])
+        middle = sorted(new_content['+read'])[len(new_content['+read']) // 2]
+        self._request(app, "list_boards", '/sdb/')
+        self._request(app, "list_posts", '/sdb/+read')
+        self._request(app, "list_posts ?before", '/sdb/+read?before={}'.format(middle))
+        self._request(app, "view_post", '/sdb/+read/{}'.format(oldest))
+        self._request(app, "master_feed", '/sdb/atom')
+        self._request(app, "board_feed ?before", '/sdb/+read/atom?before={}'.format(middle))
+        self._request(app, "search", '/sdb/search?q=dragon+party')
+        return self.results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark downloading and serving boards.")
+    parser.add_argument('--sizes', default='10,1000,100000', help="Comma separated total post counts.")
+    parser.add_argument('--latency', type=float, default=0, help="Seconds the fake MUCK waits before each reply.")
+    parser.add_argument('--repeat', type=int, default=5, help="How many times to repeat each request.")
+    parser.add_argument('--single-names', action='store_true',
+                        help="Look up names one at a time with getname. Slow because of dead dbrefs.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    results = {}  # type: Dict[int, List]
+    for size in (int(size) for size in args.sizes.split(',')):
+        results[size] = Benchmark(size, latency=args.latency, repeat=args.repeat,
+                                  batch_names=not args.single_names).run()
+
+    sizes = list(results)
+    print("{:<36}".format("step") + "".join("{:>12}".format(size) for size in sizes))
+    for i, (step, _) in enumerate(results[sizes[0]]):
+        print("{:<36}".format(step) + "".join("{:>11.4f}s".format(results[size][i][1]) for size in sizes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""
+Module for holding the board content the web app serves
+along with anything derived from it.
+"""
+from bisect import bisect_left, bisect_right
+from collections import namedtuple, OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+import hashlib
+import sys
+import threading
+import time
+
+
+class Post(namedtuple('Post', ['time', 'owner', 'owner_name', 'title', 'content'])):
+    """
+    One post on a board. Its time doubles as its id.
+
+    Posts are immutable tuples without a per-instance ``__dict__``, so they
+    can be shared by every generation, cache and view without copying.
+    Owner dbrefs and names repeat across thousands of posts so they're
+    interned to keep one copy of each.
+    """
+    __slots__ = ()
+
+    def __new__(cls, time: int, owner: str, owner_name: Optional[str], title: str, content: str):
+        return super().__new__(cls, time, sys.intern(owner),
+                               None if owner_name is None else sys.intern(owner_name), title, content)
+
+    def with_owner_name(self, owner_name: str) -> 'Post':
+        """Returns a copy of the post with ``owner_name`` filled in."""
+        return Post(self.time, self.owner, owner_name, self.title, self.content)
+
+
+def reuse_equal(old_posts: Dict[int, Post], posts: Dict[int, Post]) -> Dict[int, Post]:
+    """
+    Returns ``posts`` with every post that's equal to the one with the same
+    id in ``old_posts`` replaced by the old one, or ``old_posts`` itself if
+    they're all equal.
+
+    Posts that are downloaded or loaded again then share one copy of their
+    title and body with the old ones, and our caches, which recognize
+    unchanged content by identity, don't rebuild anything for them.
+    """
+    if old_posts == posts:
+        return old_posts
+    return {post_id: old_posts[post_id] if old_posts.get(post_id) == post else post
+            for post_id, post in posts.items()}
+
+
+class BoardIndex(object):
+    """
+    The posts on a board in time order, so that finding a post's
+    position and its neighbours doesn't need a sort.
+    """
+    def __init__(self, posts: Dict[int, Post]):
+        # Post ids are times so sorting them puts the posts in the order the MUCK numbers them.
+        self.post_ids = sorted(posts)
+        self.positions = {post_id: position for position, post_id in enumerate(self.post_ids)}
+
+    def __len__(self):
+        return len(self.post_ids)
+
+    def position(self, post_id: int) -> int:
+        """Returns the zero-based position of ``post_id`` on the board."""
+        return self.positions[post_id]
+
+    def previous(self, post_id: int) -> Optional[int]:
+        """Returns the id of the post before ``post_id`` or ``None`` if it's the first."""
+        position = self.positions[post_id]
+        return self.post_ids[position - 1] if position > 0 else None
+
+    def next(self, post_id: int) -> Optional[int]:
+        """Returns the id of the post after ``post_id`` or ``None`` if it's the last."""
+        position = self.positions[post_id]
+        return self.post_ids[position + 1] if position + 1 < len(self.post_ids) else None
+
+    def older_than(self, before: Optional[int], limit: Optional[int]) -> Tuple[int, int]:
+        """
+        Finds the newest ``limit`` posts with ids less than ``before``.
+
+        ``before`` doesn't have to be the id of a post on the board. If it's
+        ``None`` the newest posts on the board are found, and if ``limit`` is
+        ``None`` every older post is.
+
+        :return: The ``(start, end)`` positions of the posts in ``post_ids``.
+        """
+        end = len(self.post_ids) if before is None else bisect_left(self.post_ids, before)
+        start = 0 if limit is None else max(0, end - limit)
+        return start, end
+
+    def newer_than(self, after: int, limit: Optional[int]) -> Tuple[int, int]:
+        """
+        Finds the oldest ``limit`` posts with ids greater than ``after``.
+
+        :return: The ``(start, end)`` positions of the posts in ``post_ids``.
+        """
+        start = bisect_right(self.post_ids, after)
+        end = len(self.post_ids) if limit is None else min(len(self.post_ids), start + limit)
+        return start, end
+
+
+class RenderedPage(object):
+    """
+    A rendered response body along with the validators that let
+    clients skip downloading it again if they already have it.
+    """
+    def __init__(self, body: bytes, last_modified: float):
+        """
+        Args:
+            body (bytes): The response body.
+            last_modified (float): A timestamp for when the body last changed.
+        """
+        self.body = body
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.last_modified = last_modified
+
+
+class PageCache(object):
+    """
+    A least-recently-used cache of rendered pages, so that clients
+    crawling every page can't make us keep all of them rendered.
+    """
+    def __init__(self, max_size: Optional[int] = None):
+        """
+        Args:
+            max_size (int): The most pages to keep. ``None`` keeps every page.
+        """
+        self.max_size = max_size
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()  # View callables run in many threads.
+
+    def __len__(self):
+        return len(self._pages)
+
+    def get(self, key: Hashable) -> Optional[RenderedPage]:
+        """Returns the page cached under ``key`` or ``None`` if it needs to be rendered."""
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+            return page
+
+    def put(self, key: Hashable, page: RenderedPage):
+        """Caches ``page`` under ``key``, evicting the least recently used pages if full."""
+        with self._lock:
+            self._pages[key] = page
+            self._pages.move_to_end(key)
+            while self.max_size is not None and len(self._pages) > self.max_size:
+                self._pages.popitem(last=False)
+
+
+class ContentGeneration(object):
+    """
+    The content of every board as of one refresh, plus caches built from it.
+
+    A new generation is made whenever the content changes and swapped in
+    as a whole, so view callables that grab ``SpinDizzyBoards.generation``
+    once always see content and caches that agree with each other. The
+    content itself must not be modified after it's handed over.
+    """
+    def __init__(self, content: Dict[str, Dict[int, Post]], number: int,
+                 previous: Optional['ContentGeneration'] = None, max_rendered: Optional[int] = None):
+        """
+        Args:
+            content (dict): Posts keyed by board command and then post time.
+            number (int): Counts up by one with each new generation.
+            previous (ContentGeneration): The generation this one replaces.
+                Indexes of boards that haven't changed are reused from it.
+            max_rendered (int): The most rendered pages to keep. ``None``
+                keeps every page.
+        """
+        self.content = content
+        self.number = number
+        self.created = time.time()
+        self.indexes = {}
+        for board, posts in content.items():
+            if previous is not None and previous.content.get(board) is posts:
+                self.indexes[board] = previous.indexes[board]
+            else:
+                self.indexes[board] = BoardIndex(posts)
+        # RenderedPages, filled in lazily by the view callables.
+        self.rendered = PageCache(max_rendered)
+        # The pages of the generation before, so pages that come out the same keep their last modified times.
+        # Only that generation's cache is kept, not the generation, so older ones can still be freed.
+        self.previous_rendered = previous.rendered if previous is not None else None
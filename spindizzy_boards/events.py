@@ -0,0 +1,177 @@
+"""
+Module to turn changes in board content into events that
+clients and notifiers can follow instead of polling.
+"""
+from collections import deque
+from typing import Dict, Iterable, List, Optional
+import logging
+import threading
+
+from board_content import Post
+
+
+ADDED = 'added'
+REMOVED = 'removed'
+EDITED = 'edited'
+
+
+class PostEvent(object):
+    """A post that was added, removed or edited between two refreshes."""
+    def __init__(self, kind: str, board: str, post: Post, event_id: Optional[int] = None):
+        """
+        Args:
+            kind (str): One of ``ADDED``, ``REMOVED`` or ``EDITED``.
+            board (str): The board command of the post's board.
+            post (Post): The post, or what it was before it was removed.
+            event_id (int): The event's id if it's already been numbered,
+                e.g. by the process that saved it in a snapshot.
+        """
+        self.id = event_id  # Filled in by EventQueue if not given.
+        self.kind = kind
+        self.board = board
+        self.post = post
+
+    @property
+    def post_id(self) -> int:
+        return self.post.time
+
+    def to_dict(self) -> Dict:
+        return {'id': self.id,
+                'type': self.kind,
+                'board': self.board,
+                'post_id': self.post_id,
+                'title': self.post.title,
+                'owner_name': self.post.owner_name,
+               }
+
+
+def diff_content(old_content: Dict[str, Dict[int, Post]],
+                 new_content: Dict[str, Dict[int, Post]]) -> List[PostEvent]:
+    """
+    Returns events for the posts that differ between two versions of the content.
+
+    Only boards in both versions are compared so that a board being
+    downloaded for the first time doesn't announce every post on it.
+    A post whose owner's name was looked up again isn't counted as edited.
+    Boards and posts that are the same objects in both are skipped
+    without being compared.
+    """
+    events = []
+    for board, posts in new_content.items():
+        old_posts = old_content.get(board)
+        if old_posts is None or old_posts is posts:
+            continue
+        board_events = []
+        for post_id, old_post in old_posts.items():
+            post = posts.get(post_id)
+            if post is None:
+                board_events.append(PostEvent(REMOVED, board, old_post))
+            elif (post is not old_post and post != old_post
+                  and post.with_owner_name(old_post.owner_name) != old_post):
+                board_events.append(PostEvent(EDITED, board, post))
+        board_events.extend(PostEvent(ADDED, board, post)
+                            for post_id, post in posts.items() if post_id not in old_posts)
+        board_events.sort(key=lambda event: event.post_id)
+        events.extend(board_events)
+    return events
+
+
+class EventQueue(object):
+    """
+    Keeps the most recent ``max_events`` events, numbering them as they're
+    put in so that a client can ask for everything after the last one it saw.
+
+    Clients that fall so far behind that the events they missed have been
+    dropped only get the ones that are left.
+
+    Only the process that downloads content numbers events. Others
+    ``restore`` the numbered events it saves in the snapshot so that an
+    id means the same event whichever process a client asks.
+    """
+    def __init__(self, max_events: int = 1000):
+        self._events = deque(maxlen=max_events)
+        self._last_id = 0
+        self._condition = threading.Condition()
+
+    @property
+    def last_id(self) -> int:
+        """The id of the newest event, or 0 if there haven't been any."""
+        return self._last_id
+
+    def put(self, events: Iterable[PostEvent]):
+        """Numbers ``events`` and wakes up anyone waiting for them."""
+        with self._condition:
+            for event in events:
+                self._last_id += 1
+                event.id = self._last_id
+                self._events.append(event)
+            self._condition.notify_all()
+
+    def restore(self, events: Iterable[PostEvent]) -> List[PostEvent]:
+        """
+        Adds events that were numbered elsewhere, keeping their ids, and wakes
+        up anyone waiting for them. Events we already have are skipped.
+
+        :return: The events that were added.
+        """
+        with self._condition:
+            events = [event for event in events if event.id > self._last_id]
+            for event in events:
+                self._last_id = event.id
+                self._events.append(event)
+            self._condition.notify_all()
+        return events
+
+    def recent(self) -> List[PostEvent]:
+        """Returns the events we still have, oldest first."""
+        with self._condition:
+            return list(self._events)
+
+    def since(self, last_id: int, timeout: float = 0) -> List[PostEvent]:
+        """
+        Returns the events newer than ``last_id``, waiting up to ``timeout``
+        seconds for one if there aren't any yet.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._last_id > last_id, timeout)
+            return [event for event in self._events if event.id > last_id]
+
+
+class Notifier(object):
+    """Somewhere to send events as well as to clients of the web app, e.g. a Twitter account."""
+    def notify(self, events: List[PostEvent]):
+        """Sends ``events``. Only the background thread calls this."""
+        raise NotImplementedError
+
+
+class LogNotifier(Notifier):
+    """Writes events to the log."""
+    def notify(self, events: List[PostEvent]):
+        for event in events:
+            logging.info("Post {kind} on {board}: {title} by {owner}"
+                         .format(kind=event.kind, board=event.board,
+                                 title=event.post.title, owner=event.post.owner_name))
+
+
+class MemoryNotifier(Notifier):
+    """Keeps every event it's sent in ``events``. Useful for testing."""
+    def __init__(self):
+        self.events = []
+
+    def notify(self, events: List[PostEvent]):
+        self.events.extend(events)
+
+
+# Notifiers by the names used for them in config.toml.
+NOTIFIERS = {'log': LogNotifier,
+             'memory': MemoryNotifier}
+
+
+def make_notifiers(names: Iterable[str]) -> List[Notifier]:
+    """Makes a notifier for each name in ``names``, raising ``ValueError`` for unknown ones."""
+    notifiers = []
+    for name in names:
+        if name not in NOTIFIERS:
+            raise ValueError("Unknown notifier: {}".format(name))
+        notifiers.append(NOTIFIERS[name]())
+    return notifiers
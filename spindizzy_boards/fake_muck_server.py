@@ -0,0 +1,217 @@
+"""
+A stand-in MUCK for testing and benchmarking without SpinDizzy.
+
+It speaks just enough of the protocol for ``MuckDownloader``: ``connect``,
+the ``process_posts``, ``getname`` and ``getnames`` actions described in
+the README, and ``QUIT``. Boards are filled with synthetic posts, some
+of them owned by dbrefs that no longer exist.
+
+Run it with e.g. `python fake_muck_server.py --posts 1000` and point
+``config.toml`` at it with ``ssl = false``.
+"""
+from typing import Dict, Iterator, List, Optional, Tuple
+import argparse
+import logging
+import random
+import socketserver
+import threading
+import time
+
+
+_WORDS = ("muck fox wolf dragon otter board post spin dizzy furry party tonight "
+          "meeting idea server build room garden plaza code bug fix welcome news "
+          "game story scene hello thanks question answer event weekend").split()
+_FIRST_POST_TIME = 1400000000
+_PLAYER_COUNT = 500  # How many different dbrefs own posts.
+
+
+class FakePost(object):
+    """A post as the CorkBoard stores it."""
+    def __init__(self, owner: str, post_id: int, title: str, content: List[str]):
+        self.owner = owner
+        self.post_id = post_id
+        self.title = title
+        self.content = content
+
+
+class FakeMuck(object):
+    """The state of the fake MUCK: its boards and who owns what."""
+    def __init__(self, boards: Dict[str, int], dead_ref_rate: float = 0.05,
+                 lines_per_post: int = 5, seed: int = 0):
+        """
+        Args:
+            boards (dict): How many posts to make on each board, keyed by board command.
+            dead_ref_rate (float): The fraction of posters whose characters have since been deleted.
+            lines_per_post (int): The average number of lines in a post.
+            seed (int): Seeds the random content so runs are comparable.
+        """
+        self._random = random.Random(seed)
+        self.lines_per_post = lines_per_post
+        dbrefs = ['#{}'.format(1000 + i) for i in range(_PLAYER_COUNT)]
+        self.names = {dbref: 'Player{}'.format(dbref[1:]) for dbref in dbrefs
+                      if self._random.random() >= dead_ref_rate}
+        self._dbrefs = dbrefs
+        self._next_time = _FIRST_POST_TIME
+        self._lock = threading.Lock()
+        self.boards = {}  # type: Dict[str, Dict[int, FakePost]]
+        for board, count in boards.items():
+            self.boards[board] = {}
+            for _ in range(count):
+                self.add_post(board)
+
+    def _sentence(self, words: int) -> str:
+        return " ".join(self._random.choice(_WORDS) for _ in range(words))
+
+    def add_post(self, board: str) -> FakePost:
+        """Adds a new post to ``board`` and returns it."""
+        with self._lock:
+            # Posts on different boards still get different times, like on the MUCK.
+            self._next_time += self._random.randint(1, 3600)
+            lines = max(1, int(self._random.expovariate(1 / self.lines_per_post)))
+            post = FakePost(owner=self._random.choice(self._dbrefs), post_id=self._next_time,
+                            title=self._sentence(self._random.randint(2, 6)).capitalize(),
+                            content=[self._sentence(self._random.randint(0, 15)) for _ in range(lines)])
+            self.boards[board][post.post_id] = post
+            return post
+
+    def remove_post(self, board: str, post_id: int):
+        with self._lock:
+            del self.boards[board][post_id]
+
+    def process_posts(self, argument: str) -> Iterator[str]:
+        """Yields the output of `muf/get_posts.muf` for ``argument``, e.g. "+read 1494311622"."""
+        board, _, since = argument.strip().partition(" ")
+        try:
+            since = int(since.strip() or 0)
+        except ValueError:
+            since = 0
+        yield "--- START"
+        if not board:
+            yield "--- ERROR: Requires the name of a board command. e.g. '+read'"
+            return
+        if board not in self.boards:
+            yield "--- ERROR: Command not found or ambiguous."
+            return
+        with self._lock:
+            posts = list(self.boards[board].values())
+        for post in posts:
+            yield "--- ID: {}".format(post.post_id)
+        for post in posts:
+            if post.post_id <= since:
+                continue
+            yield "|owner: {}".format(post.owner)
+            yield "|time: {}".format(post.post_id)
+            yield "|title: {}".format(post.title)
+            yield "|length: {}".format(len(post.content))
+            yield "|content:"
+            for line in post.content:
+                yield "|" + line
+        yield "--- END"
+
+    def getname(self, dbref: str) -> Iterator[str]:
+        """Yields what the ``getname`` action prints. The MPI fails on a dead dbref."""
+        name = self.names.get(dbref.strip())
+        if name is None:
+            yield "(@Succ) NAME: Match failed."
+        else:
+            yield "--- NAME: " + name
+
+    def getnames(self, dbrefs: str) -> Iterator[str]:
+        """Yields what the ``getnames`` action prints."""
+        for dbref in dbrefs.split():
+            yield "--- NAME {}: {}".format(dbref, self.names.get(dbref, "UNKNOWN"))
+        yield "--- NAMES END"
+
+
+class _MuckHandler(socketserver.StreamRequestHandler):
+    """Handles one connection, reading a command per line."""
+    def handle(self):
+        muck = self.server.muck
+        for raw_line in self.rfile:
+            # Drop the telnet no-ops MuckSession sends to check the connection.
+            line = raw_line.replace(b"\xff\xf1", b"").decode('ascii', 'replace').strip()
+            if not line:
+                continue
+            command, _, argument = line.partition(" ")
+            if command == "QUIT":
+                try:
+                    self._send(["Come back later!"])
+                except ConnectionError:
+                    pass  # Clients usually hang up without waiting for this.
+                return
+            elif command == "connect":
+                output = ["Welcome to the fake MUCK."]
+            elif command == self.server.get_posts_command:
+                output = muck.process_posts(argument)
+            elif command == self.server.get_name_command:
+                output = muck.getname(argument)
+            elif command == self.server.get_names_command:
+                output = muck.getnames(argument)
+            else:
+                output = ['Huh?  (Type "help" for help.)']
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            self._send(output)
+
+    def _send(self, lines):
+        chunk = []
+        for line in lines:
+            chunk.append(line + "\r\n")
+            if len(chunk) >= 1000:
+                self.wfile.write("".join(chunk).encode())
+                chunk = []
+        self.wfile.write("".join(chunk).encode())
+
+
+class FakeMuckServer(socketserver.ThreadingTCPServer):
+    """A TCP server for a ``FakeMuck``. Each connection gets its own thread."""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, muck: FakeMuck, host: str = '127.0.0.1', port: int = 0, latency: float = 0,
+                 get_posts_command: str = 'process_posts', get_name_command: str = 'getname',
+                 get_names_command: str = 'getnames'):
+        """
+        Args:
+            port (int): The port to listen on. 0 picks a free one. See ``address``.
+            latency (float): Seconds to wait before answering each command.
+        """
+        super().__init__((host, port), _MuckHandler)
+        self.muck = muck
+        self.latency = latency
+        self.get_posts_command = get_posts_command
+        self.get_name_command = get_name_command
+        self.get_names_command = get_names_command
+        self._thread = None  # type: Optional[threading.Thread]
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self.server_address[:2]
+
+    def start(self):
+        """Serves in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a fake MUCK with synthetic boards.")
+    parser.add_argument('--port', type=int, default=7073)
+    parser.add_argument('--boards', default='+read,cread,rpread',
+                        help="Comma separated board commands.")
+    parser.add_argument('--posts', type=int, default=100, help="Posts on each board.")
+    parser.add_argument('--latency', type=float, default=0, help="Seconds to wait before each reply.")
+    parser.add_argument('--dead-ref-rate', type=float, default=0.05,
+                        help="Fraction of posters whose characters no longer exist.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    fake_muck = FakeMuck({board: args.posts for board in args.boards.split(',')},
+                         dead_ref_rate=args.dead_ref_rate)
+    server = FakeMuckServer(fake_muck, host='0.0.0.0', port=args.port, latency=args.latency)
+    logging.info("Fake MUCK listening on port {}".format(args.port))
+    server.serve_forever()
@@ -0,0 +1,253 @@
+"""
+Module to build atom feeds of board content, only redoing
+the work for boards whose posts changed.
+"""
+from datetime import datetime, tzinfo
+from html import escape
+from itertools import islice
+from typing import Dict, List, Optional, Tuple
+import heapq
+import time
+
+from feedgen.feed import FeedGenerator
+
+from board_content import ContentGeneration, Post, RenderedPage
+from metrics import count_cache_lookup, REGISTRY
+
+
+_FEED_BUILD_SECONDS = REGISTRY.histogram('spindizzy_feed_build_seconds',
+                                         "Time taken to bring the feeds up to date after a refresh.")
+
+
+def translate_content_to_xhtml(content):
+    """Try to render a board post as faithfully as possible in xhtml."""
+    # Unfortunately most readers I find strip the style attribute so we'll probably have to work on this.
+    return '<p style="white-space:pre-wrap;">{}</p>'.format(escape(content).replace('\n', '<br />'))
+
+
+class FeedBuilder(object):
+    """
+    Builds an atom feed for each board plus a ``master`` feed of all of them.
+
+    Feed entries are kept between builds, keyed by board, post time and a
+    hash of the post, so a post's content is only translated once. Boards
+    whose posts haven't changed keep their feed from the last build, and
+    the master feed is merged from the board feeds' entries, which are
+    already in order.
+    """
+    def __init__(self, board_names: Dict[str, str], tz: tzinfo, feed_domain: str,
+                 max_entries: Optional[int] = None):
+        """
+        Args:
+            board_names (dict): Board names keyed by board command.
+            tz (tzinfo): The timezone to give post times in.
+            feed_domain (str): Used to make feed and entry ids.
+            max_entries (int): Only include this many of the newest posts in
+                each feed. ``None`` includes every post.
+        """
+        self.board_names = board_names
+        self.tz = tz
+        self.feed_domain = feed_domain
+        self.max_entries = max_entries
+        self.feeds = {}  # RenderedPages keyed by board command and 'master'.
+        self._board_posts = {}  # The posts each board's feed was last built from.
+        # Each board's (post time, entry) pairs, newest first.
+        self._board_entries = {}  # type: Dict[str, List[Tuple[int, object]]]
+        # Each board's entries keyed by (post time, post hash).
+        self._entry_cache = {}  # type: Dict[str, Dict[Tuple[int, int], object]]
+
+    def _id(self, name, ts):
+        return('tag:{feed_domain},{date}:{name}'
+               .format(feed_domain=self.feed_domain,
+                       date=datetime.fromtimestamp(ts).strftime('%Y-%m-%d'),
+                       name=name))
+
+    @staticmethod
+    def _url(name: str, before: Optional[int] = None) -> str:
+        """The url of a feed, or of one of its older pages if ``before`` is given."""
+        url = '/sdb/atom' if name == 'master' else '/sdb/{}/atom'.format(name)
+        return url if before is None else '{}?before={}'.format(url, before)
+
+    def _feedgen(self, name: str, before: Optional[int] = None) -> FeedGenerator:
+        """Makes an empty feed for a board or ``master``."""
+        feedgen = FeedGenerator()
+        if name == 'master':
+            feedgen.title("SpinDizzy Boards Master")
+            feedgen.description("All posts as scraped from SpinDizzy")
+        else:
+            feedgen.title("SpinDizzy {}".format(self.board_names[name]))
+            feedgen.description("Posts scraped from {}"
+                                .format(self.board_names[name]))
+        feedgen.link({'href': self._url(name, before), 'rel': 'self'})
+        feedgen.id(self._id(name, 0))
+        return feedgen
+
+    def _make_page(self, feedgen: FeedGenerator, updated: Optional[int],
+                   old_page: Optional[RenderedPage] = None) -> RenderedPage:
+        """Renders a feed, keeping the last modified time of ``old_page`` if it hasn't changed."""
+        if updated is not None:
+            # Use the newest post's time instead of now so the feed only changes with the posts.
+            feedgen.updated(datetime.fromtimestamp(updated, tz=self.tz))
+        page = RenderedPage(feedgen.atom_str(pretty=True), last_modified=time.time())
+        if old_page is not None and old_page.etag == page.etag:
+            page.last_modified = old_page.last_modified
+        return page
+
+    def _make_entry(self, board_command: str, post: Post):
+        """Makes a feed entry for a post. It can be shared between the board and master feeds."""
+        # TODO(hyena): It would be more useful if these links were absolute.
+        # Consider adding that if we ever make the web-app aware of its own
+        # url.
+        entry = FeedGenerator().add_entry()
+        entry.title(post.title)
+        # RSS insists on an email which is annoying.
+        entry.author({'name': post.owner_name})
+        entry.updated(datetime.fromtimestamp(post.time, tz=self.tz))
+        entry.link({'href': '/sdb/{}/{}'.format(board_command, post.time), 'rel': 'alternate'})
+        entry.content(translate_content_to_xhtml(post.content), type='xhtml')
+        entry.id(self._id(name='/sdb/{}/{}'.format(board_command, post.time),
+                          ts=post.time))
+        return entry
+
+    def _entry(self, board_command: str, post: Post, new_cache: Optional[Dict] = None):
+        """Returns the cached entry for a post, making it if need be."""
+        key = (post.time, hash(post))
+        entry = self._entry_cache.get(board_command, {}).get(key)
+        count_cache_lookup('feed_entry', hit=entry is not None)
+        if entry is None:
+            entry = self._make_entry(board_command, post)
+        if new_cache is not None:
+            new_cache[key] = entry
+        return entry
+
+    def _older(self, generation: ContentGeneration, name: str,
+               before: Optional[int], limit: Optional[int]) -> List[Tuple[int, str]]:
+        """Returns ``(post id, board command)`` of the newest ``limit`` posts older than ``before``, newest first."""
+        boards = generation.content.keys() if name == 'master' else [name]
+        runs = []
+        for board_command in boards:
+            index = generation.indexes[board_command]
+            start, end = index.older_than(before, limit)
+            runs.append([(post_id, board_command) for post_id in reversed(index.post_ids[start:end])])
+        return list(islice(heapq.merge(*runs, key=lambda p: -p[0]), limit))
+
+    def _newer(self, generation: ContentGeneration, name: str,
+               after: int, limit: Optional[int]) -> List[Tuple[int, str]]:
+        """Returns ``(post id, board command)`` of the oldest ``limit`` posts newer than ``after``, oldest first."""
+        boards = generation.content.keys() if name == 'master' else [name]
+        runs = []
+        for board_command in boards:
+            index = generation.indexes[board_command]
+            start, end = index.newer_than(after, limit)
+            runs.append([(post_id, board_command) for post_id in index.post_ids[start:end]])
+        return list(islice(heapq.merge(*runs), limit))
+
+    def _add_paging_links(self, feedgen: FeedGenerator, generation: ContentGeneration, name: str,
+                          posts: List[Tuple[int, str]], before: Optional[int]):
+        """Links a page of a feed to the pages around it as described in RFC 5005."""
+        feedgen.link({'href': self._url(name), 'rel': 'first'})
+        if before is not None:
+            # The previous page holds the next max_entries newer posts. Its cursor is the post after those.
+            newest = posts[0][0] if posts else before - 1
+            newer = self._newer(generation, name, newest, self.max_entries + 1)
+            previous_before = newer[self.max_entries][0] if len(newer) > self.max_entries else None
+            feedgen.link({'href': self._url(name, previous_before), 'rel': 'previous'})
+        if posts and self._older(generation, name, posts[-1][0], 1):
+            feedgen.link({'href': self._url(name, posts[-1][0]), 'rel': 'next'})
+
+    def _build_board(self, board_command: str, generation: ContentGeneration):
+        """Rebuilds the first page of the feed for one board, reusing cached entries where we can."""
+        posts = generation.content[board_command]
+        newest = self._older(generation, board_command, None, self.max_entries)
+        new_cache = {}
+        entries = [(post_id, self._entry(board_command, posts[post_id], new_cache))
+                   for post_id, _ in newest]
+
+        board_feedgen = self._feedgen(board_command)
+        if self.max_entries is not None:
+            self._add_paging_links(board_feedgen, generation, board_command, newest, None)
+        for post_id, entry in entries:
+            board_feedgen.add_entry(feedEntry=entry)
+
+        self._entry_cache[board_command] = new_cache
+        self._board_entries[board_command] = entries
+        self._board_posts[board_command] = posts
+        return self._make_page(board_feedgen, newest[0][0] if newest else None,
+                               old_page=self.feeds.get(board_command))
+
+    def build(self, generation: ContentGeneration) -> Dict[str, RenderedPage]:
+        """
+        Brings the feeds up to date with ``generation`` and returns them.
+
+        Each feed holds the newest ``max_entries`` posts. Older posts can be
+        found by following the feed's ``next`` links. See ``page``.
+
+        :return: A dictionary with string keys, one for each board
+                 command and one for ``master``. The values are
+                 rendered XML feeds.
+        """
+        with _FEED_BUILD_SECONDS.time():
+            return self._build(generation)
+
+    def _build(self, generation: ContentGeneration) -> Dict[str, RenderedPage]:
+        new_feeds = {}
+        changed = generation.content.keys() != self._board_posts.keys()
+        for board_command, posts in generation.content.items():
+            if self._board_posts.get(board_command) is posts:
+                new_feeds[board_command] = self.feeds[board_command]
+            else:
+                new_feeds[board_command] = self._build_board(board_command, generation)
+                changed = True
+        for board_command in set(self._board_posts) - set(generation.content):
+            del self._board_posts[board_command]
+            del self._board_entries[board_command]
+            del self._entry_cache[board_command]
+
+        if changed or 'master' not in self.feeds:
+            master_feedgen = self._feedgen('master')
+            # Each board's entries are newest first so merging them keeps that order.
+            master_entries = list(islice(heapq.merge(*self._board_entries.values(), key=lambda e: -e[0]),
+                                         self.max_entries))
+            if self.max_entries is not None:
+                self._add_paging_links(master_feedgen, generation, 'master',
+                                       [(post_id, None) for post_id, entry in master_entries], None)
+            for post_id, entry in master_entries:
+                master_feedgen.add_entry(feedEntry=entry)
+            new_feeds['master'] = self._make_page(master_feedgen,
+                                                  master_entries[0][0] if master_entries else None,
+                                                  old_page=self.feeds.get('master'))
+        else:
+            new_feeds['master'] = self.feeds['master']
+
+        self.feeds = new_feeds
+        return new_feeds
+
+    def canonical_before(self, generation: ContentGeneration, name: str, before: int) -> int:
+        """
+        Returns the value of ``before`` that the feeds' own links use for the
+        page ``before`` asks for. Every ``before`` between one post and the
+        next gives the same page.
+        """
+        older = self._older(generation, name, before, 1)
+        if not older:
+            # Nothing is older, which is the same page as asking for anything older than the oldest post.
+            oldest = self._newer(generation, name, 0, 1)
+            return oldest[0][0] if oldest else 0
+        # Links to older pages are made from the post just newer than the page's newest post.
+        newer = self._newer(generation, name, older[0][0], 1)
+        return newer[0][0] if newer else older[0][0] + 1
+
+    def page(self, generation: ContentGeneration, name: str, before: int) -> RenderedPage:
+        """
+        Renders an older page of a feed: the newest ``max_entries`` posts older than ``before``.
+
+        Args:
+            name (str): A board command or ``master``.
+        """
+        posts = self._older(generation, name, before, self.max_entries)
+        feedgen = self._feedgen(name, before)
+        if self.max_entries is not None:
+            self._add_paging_links(feedgen, generation, name, posts, before)
+        for post_id, board_command in posts:
+            feedgen.add_entry(feedEntry=self._entry(board_command, generation.content[board_command][post_id]))
+        return self._make_page(feedgen, posts[0][0] if posts else None)
@@ -0,0 +1,161 @@
+"""
+Module to count and time what the app does and report it
+in the Prometheus text exposition format.
+"""
+from contextlib import contextmanager
+from typing import Dict, List, Sequence, Tuple
+import bisect
+import threading
+import time
+
+
+# Upper bounds in seconds of the buckets histograms sort observations into.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                                                     .replace('"', '\\"').replace('\n', '\\n'))
+                                    for name, value in zip(names, values)))
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != float('inf') else '+Inf'
+
+
+class _Metric(object):
+    """Holds the values of a metric for each combination of label values."""
+    kind = None
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if labels.keys() != set(self.labels):
+            raise ValueError("{name} takes the labels {labels}".format(name=self.name, labels=self.labels))
+        return tuple(labels[label] for label in self.labels)
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        """Returns the lines describing this metric."""
+        return (['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+                + self._samples())
+
+
+class Counter(_Metric):
+    """A count of something that only goes up, e.g. bytes read."""
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return ['{}{} {}'.format(self.name, _format_labels(self.labels, key), _format_value(value))
+                for key, value in values]
+
+
+class Histogram(_Metric):
+    """Counts how many observations, e.g. durations, fall into each of ``buckets``."""
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # Per bucket counts, the last being for values above every bucket, then the sum.
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes how long the body of a ``with`` statement takes, even if it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        counts = self._values.get(self._key(labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = sorted((key, list(counts)) for key, counts in self._values.items())
+        lines = []
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(self.name,
+                                                     _format_labels(self.labels + ('le',),
+                                                                    key + (_format_value(bound),)),
+                                                     cumulative))
+            labels = _format_labels(self.labels, key)
+            lines.append('{}_sum{} {}'.format(self.name, labels, _format_value(counts[-1])))
+            lines.append('{}_count{} {}'.format(self.name, labels, cumulative))
+        return lines
+
+
+class Registry(object):
+    """The metrics reported together at ``/sdb/metrics``."""
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError("Metric {} is already registered.".format(metric.name))
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        """Makes and registers a ``Counter``."""
+        return self._register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        """Makes and registers a ``Histogram``."""
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        """Returns every metric in the Prometheus text format."""
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].render())
+        return '\n'.join(lines) + '\n'
+
+
+# The registry every module registers its metrics with.
+REGISTRY = Registry()
+
+# Shared by every cache so hit rates can be compared.
+CACHE_LOOKUPS = REGISTRY.counter('spindizzy_cache_lookups_total', "Lookups in each cache by whether they hit.",
+                                 labels=('cache', 'result'))
+
+
+def count_cache_lookup(cache: str, hit: bool):
+    """Counts a lookup in ``cache``."""
+    CACHE_LOOKUPS.inc(cache=cache, result='hit' if hit else 'miss')
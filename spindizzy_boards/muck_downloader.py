@@ -2,23 +2,48 @@
 Module to read the contents of a message board
 from a remote MUCK server.
 """
-from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List
+from queue import Queue
+from typing import Dict, Iterable, List, Optional
 import json
 import logging
+import re
+import time
 
-import ssltelnet
 import toml
 
+from board_content import Post
+from metrics import count_cache_lookup, REGISTRY
+from muck_session import MuckSession
+from name_cache import NameCache, UNKNOWN_NAME
+from post_parser import parse_posts, read_lines
+
 
 _MUCK_READ_TIMEOUT = 5  # Read timeout in seconds.
+_NAMES_PER_COMMAND = 50  # How many dbrefs to send in each ``get_names_command``.
+# What ``get_name_command`` prints: the name, or the MPI error for a dbref that doesn't exist any more.
+_NAME_REPLIES = [re.compile(re.escape(b"--- NAME: ")), re.compile(rb"\(@Succ\) NAME: [^\r\n]*\r\n")]
+
+_BOARD_FETCH_SECONDS = REGISTRY.histogram('spindizzy_board_fetch_seconds',
+                                          "Time taken to download each board.", labels=('board',))
+_BOARD_FETCH_FAILURES = REGISTRY.counter('spindizzy_board_fetch_failures_total',
+                                         "Boards that couldn't be downloaded.", labels=('board',))
+_NAME_LOOKUP_SECONDS = REGISTRY.histogram('spindizzy_name_lookup_seconds',
+                                          "Time taken to look up the names missing from the cache.")
+_NAME_LOOKUP_TIMEOUTS = REGISTRY.counter('spindizzy_name_lookup_timeouts_total',
+                                         "Name lookups the MUCK didn't answer in time.")
 
 
 class MuckDownloader(object):
     """A class that facilitates downloading board contents from a MUCK such as SpinDizzy."""
     def __init__(self, host: str, port: int, ssl: bool, character: str, password: str,
-                 get_posts_command: str, get_name_command: str, boards: List[List[str]]):
+                 get_posts_command: str, get_name_command: str, boards: List[List[str]],
+                 get_names_command: Optional[str] = None,
+                 name_cache_file: Optional[str] = None, name_cache_ttl: int = 86400,
+                 keep_alive: bool = True, extra_logins: List[List[str]] = (),
+                 board_timeout: int = 120):
         self.host = host
         self.port = port
         self.ssl = ssl
@@ -26,141 +51,250 @@ class MuckDownloader(object):
         self.password = password
         self.get_posts_command = get_posts_command
         self.get_name_command = get_name_command
+        self.get_names_command = get_names_command
         self.boards = [x[0] for x in boards]
         self.board_names = [x[1] for x in boards]
-
-    def _get_posts_for_board(self, telnet, board_command='+read'):
+        self.name_cache = NameCache(path=name_cache_file, ttl=name_cache_ttl)
+        self.board_timeout = board_timeout
+        # Each login gets its own connection so boards can be downloaded in parallel.
+        # They have to be different characters since the MUCK sends a character's
+        # output to all of its connections.
+        self.sessions = [MuckSession(host=host, port=port, ssl=ssl, character=login[0],
+                                     password=login[1], keep_alive=keep_alive)
+                         for login in [[character, password]] + list(extra_logins)]
+        self._idle_sessions = Queue()
+        for session in self.sessions:
+            self._idle_sessions.put(session)
+        self._executor = ThreadPoolExecutor(len(self.sessions))
+
+    def _get_posts_for_board(self, telnet, board_command='+read', since=0, deadline=None):
         """
         Attempts to download the contents of a bulletin board.
 
         Requires that ``get_posts_command`` points to a valid
         action that launches `muf/get_posts.muf`.
+
+        Only posts newer than ``since`` are downloaded in full. Gives up
+        if the download isn't finished by ``deadline``.
+
+        :return: A tuple of a dict of the new posts keyed by time and
+                 a set of the ids of every post still on the board.
         """
         posts = {}
-        lines = deque([])
-        def check_line(line, prefix):
-            "Helper method that ensures that a line starts with a particular prefix."
-            if not line.startswith(prefix):
-                self._polite_exit(telnet=telnet)
-                raise ValueError("Expected {prefix} prefix in line: {line}".format(prefix=prefix, line=line))
-            return line.split(prefix)[1]
-
-        def read_until_careful(until):
-            "Helper method that ensures that we either successfully read a target or fail."
-            read = telnet.read_until(until, _MUCK_READ_TIMEOUT)
-            if not read.endswith(until):
-                # We dind't read our target. Bail out.
-                self._polite_exit(telnet=telnet)
-                raise ValueError("Timeout while looking for {until}.".format(until=until))
-            return read
-
+        post_ids = set()
+        argument = board_command if not since else "{} {}".format(board_command, since)
         telnet.read_very_eager()  # Clear out as much out of the pipe as possible.
-        telnet.write("{get_posts} {board}\n"
-                .format(get_posts=self.get_posts_command, board=board_command)
+        telnet.write("{get_posts} {argument}\n"
+                .format(get_posts=self.get_posts_command, argument=argument)
                 .encode(encoding='ascii'))
-        read_until_careful(b"--- START\r\n")
-
-        # Process line by line:
-        while True:
-            line = read_until_careful(b"\r\n").decode()
-            if line.startswith("--- ERROR: "):
-                raise Exception("Couldn't retrieve boards posts: " + line[len("--- ERROR: "):])
-            elif line == "--- END\r\n":
-                break
-            # Our MUF is coded to start all output with a '|' character.
-            elif line.startswith("|"):
-                # Strip out the leading "|" and the trailing "\r\n"
-                lines.append(line[1:-2])
+
+        lines = read_lines(telnet=telnet, timeout=_MUCK_READ_TIMEOUT, deadline=deadline)
+        for kind, value in parse_posts(lines):
+            if kind == 'id':
+                post_ids.add(value)
             else:
-                raise Exception("Unexpected line in board output: " + line )
-
-        while lines:
-            line = lines.popleft()
-            owner = check_line(line, prefix="owner: ")
-            line = lines.popleft()
-            time = int(check_line(line, prefix="time: "))
-            line = lines.popleft()
-            title = check_line(line, prefix="title: ")
-            line = lines.popleft()
-            length = int(check_line(line, prefix="length: "))
-            lines.popleft()  # Drop the "content:" line
-
-            content = ""
-            for count in range(length):
-                content += lines.popleft() + "\n"
-            assert time not in posts
-            posts[time] = {'owner': owner,
-                           'time': time,
-                           'title': title,
-                           'content': content}
-
-        return posts
-
-    def _lookup_name(self, telnet, dbref):
+                assert value.time not in posts
+                posts[value.time] = value
+
+        # Every post we were sent is on the board, even if the manifest is missing.
+        post_ids.update(posts)
+        return posts, post_ids
+
+    def _lookup_name(self, telnet, dbref) -> Optional[str]:
         """
         Look up the name of a dbref.
 
         Requires that ``get_name_command`` points to an action configured as
         `@succ <action>=--- NAME: {name:{&arg}}`
+
+        :return: The name, ``UNKNOWN_NAME`` if the MUCK says the dbref doesn't
+                 exist, or ``None`` if it didn't answer in time.
         """
         telnet.read_very_eager()  # Clear out as much out of the pipe as possible.
         telnet.write("{get_name} {dbref}\n"
                 .format(get_name=self.get_name_command, dbref=dbref)
                 .encode(encoding='ascii'))
-        # Use a timeout for this because it can fail on a dead ref.
-        read = telnet.read_until(b"--- NAME: ", _MUCK_READ_TIMEOUT)
-        if not read.endswith(b"--- NAME: "):
-            logging.warn("Couldn't find ref for {dbref}".format(dbref=dbref))
-            telnet.read_very_eager()  # Clear the buffer.
-            return 'UNKNOWN'
+        index, _, _ = telnet.expect(_NAME_REPLIES, _MUCK_READ_TIMEOUT)
+        if index == 1:
+            logging.warning("Couldn't find ref for {dbref}".format(dbref=dbref))
+            return UNKNOWN_NAME
+        if index == 0:
+            name = telnet.read_until(b"\r\n", _MUCK_READ_TIMEOUT)
+            if name.endswith(b"\r\n"):
+                return name[:-2].decode()
+        _NAME_LOOKUP_TIMEOUTS.inc()
+        logging.warning("Timed out looking up {dbref}".format(dbref=dbref))
+        telnet.read_very_eager()  # Clear the buffer.
+        return None
+
+    def _lookup_names(self, telnet, dbrefs: List[str]) -> Dict[str, str]:
+        """
+        Look up the names of many dbrefs with a few commands instead of one per dbref.
+
+        Requires that ``get_names_command`` points to an action configured as
+        `@succ <action>={foreach:ref,{&arg},--- NAME {&ref}: {if:{ok:{&ref}},{name:{&ref}},UNKNOWN}{nl}, }--- NAMES END`
 
-        name = telnet.read_until(b"\r\n", _MUCK_READ_TIMEOUT)
-        return name[:-2].decode()
+        Every reply is tagged with its dbref so a missing one can't shift the rest.
 
-    def _polite_exit(self, telnet):
+        :return: The names of the dbrefs the MUCK answered for in time, which
+                 are ``UNKNOWN_NAME`` for dbrefs that don't exist any more.
+        """
+        batches = [dbrefs[i:i + _NAMES_PER_COMMAND] for i in range(0, len(dbrefs), _NAMES_PER_COMMAND)]
+        telnet.read_very_eager()  # Clear out as much out of the pipe as possible.
+        # Send all the commands before reading any replies so we only wait on the MUCK once.
+        for batch in batches:
+            telnet.write("{get_names} {dbrefs}\n"
+                    .format(get_names=self.get_names_command, dbrefs=" ".join(batch))
+                    .encode(encoding='ascii'))
+
+        names = {}
+        remaining = len(batches)
+        while remaining:
+            line = telnet.read_until(b"\r\n", _MUCK_READ_TIMEOUT)
+            if not line.endswith(b"\r\n"):
+                _NAME_LOOKUP_TIMEOUTS.inc()
+                logging.warning("Timed out waiting for {count} batches of names.".format(count=remaining))
+                break
+            line = line[:-2].decode()
+            if line == "--- NAMES END":
+                remaining -= 1
+            elif line.startswith("--- NAME #"):
+                dbref, _, name = line[len("--- NAME "):].partition(": ")
+                names[dbref] = name
+        return names
+
+    def resolve_names(self, dbrefs: Iterable[str]) -> Dict[str, str]:
         """
-        Attempt to bail from the server politely so we don't leave connections around.
+        Returns the names of ``dbrefs``, only asking the MUCK about ones that aren't cached.
 
-        Called in the case of a logic error.
+        Dbrefs the MUCK didn't answer for in time are left out, and aren't
+        cached, so that they're asked about again next time.
         """
-        telnet.write("\nQUIT\n".encode(encoding='ascii'))
-        telnet.close()
+        names = {}
+        missing = []
+        for dbref in dbrefs:
+            name = self.name_cache.get(dbref)
+            count_cache_lookup('name', hit=name is not None)
+            if name is None:
+                missing.append(dbref)
+            else:
+                names[dbref] = name
+        if not missing:
+            return names
+        looked_up = {}
+        try:
+            with _NAME_LOOKUP_SECONDS.time(), self._connection() as telnet:
+                if self.get_names_command:
+                    looked_up = self._lookup_names(telnet=telnet, dbrefs=missing)
+                else:
+                    for dbref in missing:
+                        name = self._lookup_name(telnet=telnet, dbref=dbref)
+                        if name is None:
+                            # The reply could still turn up and be taken for the next dbref's name.
+                            raise TimeoutError("Timed out looking up {dbref}".format(dbref=dbref))
+                        looked_up[dbref] = name
+        except TimeoutError:
+            # The connection has been dropped so the rest are looked up afresh next time.
+            logging.warning("Left {count} names to look up next time."
+                            .format(count=len(missing) - len(looked_up)))
+        for dbref, name in looked_up.items():
+            self.name_cache.put(dbref, name)
+        self.name_cache.save()
+        names.update(looked_up)
+        return names
+
+    @contextmanager
+    def _connection(self):
+        """Checks a session out of the pool and yields its logged in connection."""
+        session = self._idle_sessions.get()
+        try:
+            telnet = session.acquire()
+            try:
+                yield telnet
+            except:
+                # We don't know what state the connection is in now so don't reuse it.
+                session.discard()
+                raise
+            session.release()
+        finally:
+            self._idle_sessions.put(session)
+
+    def _fetch_board(self, board_command: str, since: int):
+        """Downloads one board over whichever connection is free. Run in ``_executor``."""
+        logging.debug("Retrieving posts for {board}".format(board=board_command))
+        deadline = time.time() + self.board_timeout
+        with _BOARD_FETCH_SECONDS.time(board=board_command), self._connection() as telnet:
+            return self._get_posts_for_board(telnet=telnet, board_command=board_command,
+                                             since=since, deadline=deadline)
+
+    def close(self):
+        """Logs out of the MUCK if we're still connected."""
+        for session in self.sessions:
+            session.close()
 
     def get_posts(self):
         """Downloads the contents of all the configured boards, returning them as a dict."""
-        # Connect to the MUCK
-        s = ssltelnet.SslTelnet(force_ssl=self.ssl,
-                                host=self.host,
-                                port=self.port)
-        s.write("connect {character} {password}\n"
-                .format(character=self.character, password=self.password)
-                .encode(encoding='ascii'))  # Oh for the day when UTF-8 is a reality.
-        logging.debug("Connected to {server} and logged in as {character}."
-                      .format(server=self.host, character=self.character))
-
-        # Download all the posts for all the boards.
-        boards = {}
-        for board_command in self.boards:
-            logging.debug("Retrieving posts for {board}".format(board=board_command))
-            boards[board_command] = self._get_posts_for_board(telnet=s, board_command=board_command)
-
-        # We now have all the posts - but the names are dbrefs. Find all the names to look up and fix them.
+        updates = self._download(since={})
+        return {board: update['posts'] for board, update in updates.items()}
+
+    def get_updates(self, since: Dict[str, int], boards: Optional[Iterable[str]] = None):
+        """
+        Downloads the changes to the configured boards.
+
+        Args:
+            since (dict): The time of the newest post we already have from
+                each board. Boards that aren't in it are downloaded in full.
+            boards (list): The board commands to download. Defaults to all of them.
+
+        Posts are identified by their time so edits to an existing post
+        won't be noticed.
+
+        :return: A dict keyed by board command. Each value is a dict with
+                 ``posts``, the new posts keyed by time, and ``ids``, the
+                 set of ids of every post still on the board.
+        """
+        return self._download(since=since, boards=boards)
+
+    def _download(self, since: Dict[str, int], boards: Optional[Iterable[str]] = None):
+        """
+        Downloads posts newer than ``since[board]`` for each of ``boards``,
+        or every board if it's ``None``. See ``get_updates``.
+
+        Boards that fail to download are left out of the result. An
+        exception is only raised if none of them could be downloaded.
+        """
+        # Download all the new posts for all the boards, as many at a time as we have connections.
+        futures = {board_command: self._executor.submit(self._fetch_board, board_command,
+                                                        since.get(board_command, 0))
+                   for board_command in (self.boards if boards is None else boards)}
+        updates = {}
+        error = None
+        for board_command, future in futures.items():
+            try:
+                posts, post_ids = future.result()
+            except Exception as e:
+                _BOARD_FETCH_FAILURES.inc(board=board_command)
+                logging.warning("Couldn't download {board}".format(board=board_command), exc_info=True)
+                error = e
+                continue
+            updates[board_command] = {'posts': posts, 'ids': post_ids}
+            logging.debug("{count} new posts on {board}".format(count=len(posts), board=board_command))
+        if not updates and error is not None:
+            raise error
+
+        # We now have all the new posts - but the names are dbrefs. Find all the names to look up and fix them.
         logging.debug("Looking up names.")
         owner_dbrefs = set({})
-        names = {}
-        for board in boards.values():
-            for post in board.values():
-                owner_dbrefs.add(post['owner'])
-        for dbref in owner_dbrefs:
-            names[dbref] = self._lookup_name(telnet=s, dbref=dbref)
-        # Include owner names
-        for board in boards.values():
-            for post in board.values():
-                post['owner_name'] = names[post['owner']]
+        for update in updates.values():
+            for post in update['posts'].values():
+                owner_dbrefs.add(post.owner)
+        names = self.resolve_names(dbrefs=owner_dbrefs)
+        # Include owner names. Ones that couldn't be looked up this time are unknown until they can.
+        for update in updates.values():
+            update['posts'] = {post_id: post.with_owner_name(names.get(post.owner, UNKNOWN_NAME))
+                               for post_id, post in update['posts'].items()}
         logging.debug("Done formatting boards.")
-
-        self._polite_exit(telnet=s)
-        return boards
+        return updates
 
 
 class FakeMuckDownloader(object):
@@ -168,7 +302,7 @@ class FakeMuckDownloader(object):
     such as SpinDizzy. This allows us to test the webapp without setting up a 'live' muck
     account and running the MUF every time."""
     def __init__(self, host: str, port: int, ssl: bool, character: str, password: str,
-                 get_posts_command: str, get_name_command: str, boards: List[List[str]]):
+                 get_posts_command: str, get_name_command: str, boards: List[List[str]], **kwargs):
         pass
 
     def get_posts(self):
@@ -177,7 +311,7 @@ class FakeMuckDownloader(object):
         # at a fixed interval, and serve all posts where post.date <= now...
         logging.debug("(fake) MuckDownloader.get_posts() at {}"
                           .format(datetime.now().strftime("%D %T")))
-        return {
+        content = {
             '+read': {
                 1495648230: {
                     'owner': '#1234',
@@ -202,6 +336,16 @@ Bull, our new application for perfect epistemologies, is the solution to all of
 We proceed as follows. Primarily, we motivate the need for the transistor. We place our work in context with the existing work in this area. To address this issue, we construct a methodology for IPv7 (Bull), proving that gigabit switches and the transistor are largely incompatible [10]. Similarly, we place our work in context with the previous work in this area. Finally, we conclude."""}
             }
         }
+        return {board: {post_id: Post(**post) for post_id, post in posts.items()}
+                for board, posts in content.items()}
+
+    def resolve_names(self, dbrefs):
+        # Fake posts come with their names.
+        return {}
+
+    def get_updates(self, since, boards=None):
+        return {board: {'posts': posts, 'ids': set(posts)}
+                for board, posts in self.get_posts().items() if boards is None or board in boards}
 
 
 if __name__ == '__main__':
@@ -209,4 +353,6 @@ if __name__ == '__main__':
     with open("config.toml") as config_file:
         conf = toml.loads(config_file.read())
     downloader = MuckDownloader(**(conf['muck']))
-    print(json.dumps(downloader.get_posts(), indent=4))
+    print(json.dumps({board: [post._asdict() for post in posts.values()]
+                      for board, posts in downloader.get_posts().items()}, indent=4))
+    downloader.close()
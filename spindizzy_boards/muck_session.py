@@ -0,0 +1,123 @@
+"""
+Module to keep a logged in connection to a MUCK open
+between downloads.
+"""
+import logging
+import time
+
+import ssltelnet
+
+from metrics import REGISTRY
+
+
+_IAC_NOP = bytes([255, 241])  # A telnet no-op. The MUCK ignores it but it fails on a dead socket.
+
+_CONNECT_SECONDS = REGISTRY.histogram('spindizzy_muck_connect_seconds',
+                                      "Time taken to connect and log in to the MUCK.")
+_CONNECT_FAILURES = REGISTRY.counter('spindizzy_muck_connect_failures_total',
+                                     "Failed attempts to connect to the MUCK.")
+
+
+class MuckSession(object):
+    """
+    A connection to a MUCK that stays logged in between uses.
+
+    The connection is checked before it's handed out and re-opened if
+    it died. Failed connection attempts back off exponentially so we
+    don't hammer a MUCK that's down.
+    """
+    def __init__(self, host: str, port: int, ssl: bool, character: str, password: str,
+                 keep_alive: bool = True, min_backoff: int = 5, max_backoff: int = 600):
+        """
+        Args:
+            keep_alive (bool): If false, log out after every use like we used to.
+            min_backoff (int): Seconds to wait before retrying after the first failure.
+            max_backoff (int): The longest we'll wait between connection attempts in seconds.
+        """
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.character = character
+        self.password = password
+        self.keep_alive = keep_alive
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.telnet = None
+        self._failures = 0
+        self._next_attempt = 0
+
+    def acquire(self):
+        """
+        Returns a logged in telnet connection, connecting if we don't have a live one.
+
+        Raises ``ConnectionError`` if we're still backing off from a failed attempt.
+        """
+        if self.telnet is not None and not self._is_alive():
+            logging.info("Lost connection to {server}. Reconnecting.".format(server=self.host))
+            self.telnet.close()
+            self.telnet = None
+        if self.telnet is None:
+            self._connect()
+        return self.telnet
+
+    def release(self):
+        """Called when done with the connection from ``acquire``."""
+        if not self.keep_alive:
+            self.close()
+
+    def discard(self):
+        """Drops the connection, e.g. after an error left it in an unknown state."""
+        self.close()
+
+    def close(self):
+        """Logs out if we're connected."""
+        if self.telnet is None:
+            return
+        try:
+            self._polite_exit(telnet=self.telnet)
+        except OSError:
+            self.telnet.close()
+        self.telnet = None
+
+    def _is_alive(self) -> bool:
+        """Cheaply checks that the connection is still up."""
+        try:
+            self.telnet.read_very_eager()  # Raises EOFError if the MUCK hung up on us.
+            self.telnet.get_socket().sendall(_IAC_NOP)
+        except (EOFError, OSError):
+            return False
+        return True
+
+    def _connect(self):
+        """Connects and logs in, backing off on failure."""
+        now = time.time()
+        if now < self._next_attempt:
+            raise ConnectionError("Not reconnecting to {server} for another {seconds:.0f} seconds."
+                                  .format(server=self.host, seconds=self._next_attempt - now))
+        try:
+            with _CONNECT_SECONDS.time():
+                telnet = ssltelnet.SslTelnet(force_ssl=self.ssl,
+                                             host=self.host,
+                                             port=self.port)
+                telnet.write("connect {character} {password}\n"
+                             .format(character=self.character, password=self.password)
+                             .encode(encoding='ascii'))  # Oh for the day when UTF-8 is a reality.
+        except OSError:
+            _CONNECT_FAILURES.inc()
+            self._failures += 1
+            backoff = min(self.max_backoff, self.min_backoff * 2 ** (self._failures - 1))
+            self._next_attempt = now + backoff
+            logging.warning("Couldn't connect to {server}. Retrying in {seconds} seconds."
+                            .format(server=self.host, seconds=backoff))
+            raise
+        self._failures = 0
+        self.telnet = telnet
+        logging.debug("Connected to {server} and logged in as {character}."
+                      .format(server=self.host, character=self.character))
+
+    def _polite_exit(self, telnet):
+        """
+        Attempt to bail from the server politely so we don't leave connections around.
+        """
+        telnet.write("\nQUIT\n".encode(encoding='ascii'))
+        telnet.close()
@@ -0,0 +1,91 @@
+"""
+Module to remember the names of MUCK dbrefs between downloads
+and restarts so that we don't have to look them up every time.
+"""
+from collections import OrderedDict
+from typing import Optional
+import json
+import logging
+import os
+import time
+
+
+UNKNOWN_NAME = 'UNKNOWN'  # The name given to dbrefs that couldn't be looked up.
+
+
+class NameCache(object):
+    """
+    A least-recently-used cache of dbref to name lookups.
+
+    Names expire after ``ttl`` seconds so that renamed characters are
+    eventually noticed. Failed lookups are cached as ``UNKNOWN_NAME`` for
+    the shorter ``negative_ttl`` so that a dead ref doesn't cost a lookup
+    timeout on every download.
+    """
+    def __init__(self, path: Optional[str] = None, ttl: int = 86400,
+                 negative_ttl: int = 3600, max_size: int = 10000):
+        """
+        Args:
+            path (str): A file to persist the cache to. If ``None`` the
+                        cache only lives in memory.
+            ttl (int): Seconds to remember a name for.
+            negative_ttl (int): Seconds to remember a failed lookup for.
+            max_size (int): The most dbrefs to remember.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # dbref -> (name, expiry time)
+        self._dirty = False
+        if path is not None:
+            self.load()
+
+    def get(self, dbref: str) -> Optional[str]:
+        """Returns the cached name for ``dbref`` or ``None`` if it needs to be looked up."""
+        entry = self._entries.get(dbref)
+        if entry is None:
+            return None
+        name, expires = entry
+        if expires <= time.time():
+            del self._entries[dbref]
+            self._dirty = True
+            return None
+        self._entries.move_to_end(dbref)
+        return name
+
+    def put(self, dbref: str, name: str):
+        """Remembers the name of ``dbref``, evicting the least recently used entries if full."""
+        ttl = self.negative_ttl if name == UNKNOWN_NAME else self.ttl
+        self._entries[dbref] = (name, time.time() + ttl)
+        self._entries.move_to_end(dbref)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        self._dirty = True
+
+    def load(self):
+        """Loads the cache from ``path``, ignoring expired entries."""
+        try:
+            with open(self.path) as cache_file:
+                entries = json.load(cache_file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            logging.warning("Couldn't load name cache from {path}".format(path=self.path), exc_info=True)
+            return
+        now = time.time()
+        for dbref, name, expires in entries[-self.max_size:]:
+            if expires > now:
+                self._entries[dbref] = (name, expires)
+
+    def save(self):
+        """Writes the cache to ``path`` if anything changed since the last save."""
+        if self.path is None or not self._dirty:
+            return
+        # Write to a temporary file first so a crash can't leave a truncated cache behind.
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as cache_file:
+            json.dump([[dbref, name, expires] for dbref, (name, expires) in self._entries.items()],
+                      cache_file)
+        os.replace(temp_path, self.path)
+        self._dirty = False
@@ -0,0 +1,154 @@
+"""
+Module to parse the output of `muf/get_posts.muf` as it
+arrives rather than after the whole board has been read.
+"""
+from typing import Iterable, Iterator, Optional, Tuple
+import select
+import time
+
+from board_content import Post
+from metrics import REGISTRY
+
+
+_BYTES_READ = REGISTRY.counter('spindizzy_muck_bytes_read_total', "Bytes of board output read from the MUCK.")
+_POSTS_PARSED = REGISTRY.counter('spindizzy_posts_parsed_total', "Posts parsed from board output.")
+
+_READ_SIZE = 65536  # How much to read from the socket at a time.
+# Telnet command bytes. See RFC 854.
+_IAC = bytes([255])
+_DONT = bytes([254])
+_DO = bytes([253])
+_WONT = bytes([252])
+_WILL = bytes([251])
+_SB = bytes([250])
+_SE = bytes([240])
+
+
+def _telnet_data(buffer: bytes, sock) -> Tuple[bytes, bytes]:
+    """
+    Takes the telnet commands out of ``buffer``, turning down any options
+    the MUCK asks for like telnetlib would.
+
+    :return: The data and whatever's left over at the end of ``buffer``
+             because it's the start of a command we haven't read all of.
+    """
+    if _IAC not in buffer:
+        return buffer, b""
+    data = []
+    start = 0
+    while True:
+        iac = buffer.find(_IAC, start)
+        if iac < 0:
+            data.append(buffer[start:])
+            return b"".join(data), b""
+        data.append(buffer[start:iac])
+        command = buffer[iac + 1:iac + 2]
+        if not command:
+            return b"".join(data), buffer[iac:]
+        if command == _IAC:
+            data.append(_IAC)  # An escaped 255 byte.
+            start = iac + 2
+        elif command in (_DO, _DONT, _WILL, _WONT):
+            option = buffer[iac + 2:iac + 3]
+            if not option:
+                return b"".join(data), buffer[iac:]
+            if command == _DO:
+                sock.sendall(_IAC + _WONT + option)
+            elif command == _WILL:
+                sock.sendall(_IAC + _DONT + option)
+            start = iac + 3
+        elif command == _SB:
+            end = buffer.find(_IAC + _SE, iac + 2)
+            if end < 0:
+                return b"".join(data), buffer[iac:]
+            start = end + 2
+        else:
+            start = iac + 2  # e.g. NOP or GA, which carry no data.
+
+
+def read_lines(telnet, timeout: float, deadline: Optional[float] = None) -> Iterator[str]:
+    """
+    Yields lines from a telnet connection without their trailing "\\r\\n".
+
+    Reads straight from the socket in large chunks. telnetlib reads 50
+    bytes at a time and copies everything it has buffered on each read,
+    which makes reading a large board take time quadratic in its size.
+
+    Raises ``TimeoutError`` if nothing arrives within ``timeout`` seconds
+    or if ``deadline`` passes, and ``EOFError`` if the MUCK hangs up.
+    """
+    sock = telnet.get_socket()
+    # Start with anything telnetlib has already read off the socket.
+    partial = telnet.read_lazy()
+    raw = b""
+    while True:
+        if deadline is not None and time.time() > deadline:
+            raise TimeoutError("Gave up waiting for the rest of the board.")
+        # An SSL socket can hold decrypted data that select() doesn't know about.
+        if not (hasattr(sock, 'pending') and sock.pending()):
+            wait = timeout if deadline is None else max(0, min(timeout, deadline - time.time()))
+            readable, _, _ = select.select([sock], [], [], wait)
+            if not readable:
+                if deadline is not None and time.time() > deadline:
+                    raise TimeoutError("Gave up waiting for the rest of the board.")
+                raise TimeoutError("Timeout while reading board output.")
+        chunk = sock.recv(_READ_SIZE)
+        if not chunk:
+            raise EOFError("Connection closed while reading board output.")
+        _BYTES_READ.inc(len(chunk))
+        data, raw = _telnet_data(raw + chunk, sock)
+        lines = (partial + data).split(b"\r\n")
+        partial = lines.pop()  # Either empty or the start of a line we haven't finished reading.
+        for line in lines:
+            yield line.decode()
+
+
+def _field(lines: Iterator[str], prefix: str) -> str:
+    """Returns the next line with ``prefix`` stripped, making sure it was there."""
+    line = next(lines, None)
+    if line is None:
+        raise ValueError("Board output ended while looking for {prefix} prefix.".format(prefix=prefix))
+    if not line.startswith(prefix):
+        raise ValueError("Expected {prefix} prefix in line: {line}".format(prefix=prefix, line=line))
+    return line[len(prefix):]
+
+
+def parse_posts(lines: Iterable[str]) -> Iterator[Tuple[str, object]]:
+    """
+    Parses the output of `get_posts.muf`, skipping anything before ``--- START``
+    and stopping at ``--- END``.
+
+    Yields ``('id', post_id)`` for each post listed as still on the board
+    and ``('post', post)`` as soon as each post has been read in full.
+    """
+    lines = iter(lines)
+    for line in lines:
+        if line == "--- START":
+            break
+
+    for line in lines:
+        if line.startswith("--- ERROR: "):
+            raise Exception("Couldn't retrieve boards posts: " + line[len("--- ERROR: "):])
+        elif line == "--- END":
+            return
+        elif line.startswith("--- ID: "):
+            yield 'id', int(line[len("--- ID: "):])
+        # Our MUF is coded to start all post output with a '|' character.
+        elif line.startswith("|owner: "):
+            post = _parse_post(owner=line[len("|owner: "):], lines=lines)
+            _POSTS_PARSED.inc()
+            yield 'post', post
+        else:
+            raise Exception("Unexpected line in board output: " + line)
+    raise ValueError("Board output ended without --- END.")
+
+
+def _parse_post(owner: str, lines: Iterator[str]) -> Post:
+    """Reads the rest of a post after its ``|owner:`` line. The owner's name is left out."""
+    post_time = int(_field(lines, "|time: "))
+    title = _field(lines, "|title: ")
+    length = int(_field(lines, "|length: "))
+    _field(lines, "|content:")
+    content = [_field(lines, "|") for count in range(length)]
+    return Post(time=post_time, owner=owner, owner_name=None, title=title,
+                content="".join(line + "\n" for line in content))
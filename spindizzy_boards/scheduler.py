@@ -0,0 +1,104 @@
+"""
+Module to decide when each board should next be downloaded,
+based on how busy it's been and whether downloading it worked.
+"""
+from typing import Iterable, List, Optional
+import random
+import threading
+import time
+
+
+_SPEED_UP = 0.5  # The interval is multiplied by this after a poll that found new posts.
+_SLOW_DOWN = 1.5  # And by this after one that didn't.
+# Boards due within this fraction of min_interval are polled along with those that are due now.
+_BATCH_WINDOW = 0.1
+
+
+class PollScheduler(object):
+    """
+    Keeps a polling interval for each board between ``min_interval`` and
+    ``max_interval``. A board's interval shrinks each time it's found to have
+    new posts and grows each time it hasn't, so busy boards are polled
+    often and quiet ones rarely.
+
+    When a board fails to download it's retried after its interval doubled
+    once for every failure in a row, up to ``max_backoff``. Every delay is
+    randomly stretched or shrunk by up to ``jitter`` so retries after an
+    outage don't all land at once.
+
+    ``due`` and the ``record_*`` methods are only called by the background
+    thread. ``refresh_now`` can be called from anywhere.
+    """
+    def __init__(self, boards: Iterable[str], interval: float, min_interval: float,
+                 max_interval: float, max_backoff: float, jitter: float = 0.1):
+        """
+        Args:
+            boards (list): The board commands to schedule.
+            interval (float): The interval boards start with in seconds.
+            min_interval (float): The shortest interval in seconds.
+            max_interval (float): The longest interval in seconds while
+                downloads are working.
+            max_backoff (float): The longest delay in seconds after failures.
+            jitter (float): How much to randomly vary delays by as a fraction.
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        start = min(max(interval, min_interval), max_interval)
+        self.intervals = {board: start for board in boards}
+        self.failures = {board: 0 for board in boards}
+        self.next_poll = {board: 0 for board in boards}  # Every board is due straight away.
+        # Boards refresh_now asked for that haven't started downloading since.
+        # Boards already downloading when it's called are kept due when they finish.
+        self._refresh_pending = set()
+        self._wake = threading.Event()
+
+    def _jittered(self, delay: float) -> float:
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def due(self, now: Optional[float] = None) -> List[str]:
+        """Returns the boards that should be polled now."""
+        now = time.time() if now is None else now
+        horizon = now + self.min_interval * _BATCH_WINDOW
+        boards = [board for board, next_poll in self.next_poll.items() if next_poll <= horizon]
+        self._refresh_pending.difference_update(boards)
+        return boards
+
+    def record_success(self, board: str, new_posts: int, now: Optional[float] = None):
+        """Schedules the next poll of a board that was just downloaded and had ``new_posts`` new posts."""
+        now = time.time() if now is None else now
+        factor = _SPEED_UP if new_posts else _SLOW_DOWN
+        self.intervals[board] = min(max(self.intervals[board] * factor, self.min_interval), self.max_interval)
+        self.failures[board] = 0
+        self.next_poll[board] = now + self._jittered(self.intervals[board])
+        self._keep_refresh(board)
+
+    def record_failure(self, board: str, now: Optional[float] = None):
+        """Schedules a retry of a board that couldn't be downloaded."""
+        now = time.time() if now is None else now
+        self.failures[board] += 1
+        # Cap the exponent too so a long outage can't overflow the float.
+        backoff = self.intervals[board] * 2 ** min(self.failures[board], 32)
+        self.next_poll[board] = now + self._jittered(min(backoff, self.max_backoff))
+        self._keep_refresh(board)
+
+    def _keep_refresh(self, board: str):
+        """Makes ``board`` due again if ``refresh_now`` was called while it was downloading."""
+        # Checked after next_poll is set so a call to refresh_now at any point isn't lost.
+        if board in self._refresh_pending:
+            self.next_poll[board] = 0
+
+    def refresh_now(self):
+        """Makes every board due, including ones that are downloading now, and wakes up ``wait``."""
+        self._refresh_pending.update(self.next_poll)
+        for board in self.next_poll:
+            self.next_poll[board] = 0
+        self._wake.set()
+
+    def wait(self):
+        """Sleeps until a board is due or ``refresh_now`` is called."""
+        delay = min(self.next_poll.values(), default=0) - time.time()
+        if delay > 0:
+            self._wake.wait(delay)
+        self._wake.clear()
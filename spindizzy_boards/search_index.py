@@ -0,0 +1,111 @@
+"""
+Module for searching board posts with an in-memory inverted
+index that's kept up to date as content is downloaded.
+"""
+from typing import Dict, List, Optional, Tuple
+import heapq
+import math
+import re
+import threading
+
+from board_content import Post
+
+
+_WORD_RE = re.compile(r"\w+")
+# How much a match in each field counts towards a post's score.
+_FIELD_WEIGHTS = {'title': 3.0, 'owner_name': 2.0, 'content': 1.0}
+
+
+def tokenize(text: str) -> List[str]:
+    """Splits text into lower-cased words."""
+    return [word.lower() for word in _WORD_RE.findall(text)]
+
+
+class SearchIndex(object):
+    """
+    An inverted index over the ``title``, ``content`` and ``owner_name`` of posts.
+
+    Posts are identified by ``(board command, post id)``. The background
+    thread updates the index while view callables search it, so all access
+    goes through a lock.
+    """
+    def __init__(self):
+        self._postings = {}  # type: Dict[str, Dict[Tuple[str, int], float]]
+        self._terms = {}  # The terms each post was indexed under, so it can be removed.
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._terms)
+
+    def _add(self, board: str, post: Post):
+        key = (board, post.time)
+        weights = {}
+        for field, field_weight in _FIELD_WEIGHTS.items():
+            for term in tokenize(getattr(post, field)):
+                weights[term] = weights.get(term, 0.0) + field_weight
+        for term, weight in weights.items():
+            self._postings.setdefault(term, {})[key] = weight
+        self._terms[key] = weights.keys()
+
+    def _remove(self, board: str, post_id: int):
+        key = (board, post_id)
+        for term in self._terms.pop(key, ()):
+            postings = self._postings[term]
+            del postings[key]
+            if not postings:
+                del self._postings[term]
+
+    def update(self, old_content: Dict[str, Dict[int, Post]], new_content: Dict[str, Dict[int, Post]]):
+        """
+        Brings the index from ``old_content`` up to date with ``new_content``,
+        only touching posts that were added, removed or replaced.
+        """
+        with self._lock:
+            for board in old_content.keys() - new_content.keys():
+                for post_id in old_content[board]:
+                    self._remove(board, post_id)
+            for board, posts in new_content.items():
+                old_posts = old_content.get(board, {})
+                if old_posts is posts:
+                    continue
+                for post_id, old_post in old_posts.items():
+                    if posts.get(post_id) is not old_post:
+                        self._remove(board, post_id)
+                for post_id, post in posts.items():
+                    if old_posts.get(post_id) is not post:
+                        self._add(board, post)
+
+    def search(self, query: str, board: Optional[str] = None,
+               offset: int = 0, limit: int = 20) -> Tuple[int, List[Tuple[str, int]]]:
+        """
+        Finds the posts that contain every word in ``query``, best matches first.
+
+        Matches are scored by how often and in which fields each word
+        appears, with rarer words counting for more. Ties go to newer posts.
+
+        Args:
+            board (str): Only search this board.
+
+        :return: The total number of matches and a list of the
+                 ``(board command, post id)`` of up to ``limit`` of them
+                 after skipping ``offset``.
+        """
+        terms = set(tokenize(query))
+        if not terms:
+            return 0, []
+        with self._lock:
+            postings = [self._postings.get(term, {}) for term in terms]
+            total_posts = len(self._terms)
+            # Start from the rarest term so there's less to intersect.
+            postings.sort(key=len)
+            matches = {key: 0.0 for key in postings[0] if board is None or key[0] == board}
+            for term_postings in postings:
+                idf = 1 + math.log(total_posts / len(term_postings)) if term_postings else 0
+                for key in list(matches):
+                    weight = term_postings.get(key)
+                    if weight is None:
+                        del matches[key]
+                    else:
+                        matches[key] += weight * idf
+        best = heapq.nlargest(offset + limit, matches.items(), key=lambda m: (m[1], m[0][1]))
+        return len(matches), [key for key, score in best[offset:]]
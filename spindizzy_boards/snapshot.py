@@ -0,0 +1,81 @@
+"""
+Module to save board content to disk so that a restarted
+web app has something to serve before its first download.
+"""
+from typing import Dict, List, Optional, Tuple
+import json
+import logging
+import os
+
+from board_content import Post
+from events import PostEvent
+
+
+# Version 1 stored each post as a dict. Version 2 stores it as a list of the fields of ``Post``,
+# and optionally the recent events as lists of their id, kind, board and post.
+_SNAPSHOT_VERSION = 2
+
+
+class SnapshotStore(object):
+    """
+    Keeps the latest board content, and the events for the latest
+    changes to it, in a JSON file.
+
+    The file is replaced atomically on every save so a reader never sees
+    a half-written snapshot.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._loaded_mtime = None  # The modification time of the file when we last loaded it.
+
+    def _mtime(self) -> Optional[float]:
+        try:
+            return os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def changed(self) -> bool:
+        """Returns whether the file has been replaced since we last loaded it."""
+        mtime = self._mtime()
+        return mtime is not None and mtime != self._loaded_mtime
+
+    def save(self, content: Dict[str, Dict[int, Post]], events: List[PostEvent] = ()):
+        """Writes ``content`` and ``events`` to the snapshot file, replacing what was there."""
+        # Posts are tuples so json writes them as lists.
+        snapshot = {'version': _SNAPSHOT_VERSION,
+                    'boards': {board: list(posts.values()) for board, posts in content.items()},
+                    'events': [[event.id, event.kind, event.board, event.post] for event in events]}
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+        os.replace(temp_path, self.path)
+
+    def load(self) -> Optional[Tuple[Dict[str, Dict[int, Post]], List[PostEvent]]]:
+        """
+        Reads the snapshot file.
+
+        :return: Posts keyed by board command and then post time, and the
+                 saved events oldest first, or ``None`` if there's no usable
+                 snapshot.
+        """
+        # Check the time first so we'd load it again if it's replaced while we're reading.
+        self._loaded_mtime = self._mtime()
+        try:
+            with open(self.path) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            logging.warning("Couldn't load snapshot from {path}".format(path=self.path), exc_info=True)
+            return None
+        version = snapshot.get('version')
+        if version not in (1, _SNAPSHOT_VERSION):
+            logging.warning("Ignoring snapshot {path} with unknown version.".format(path=self.path))
+            return None
+        content = {}
+        for board, posts in snapshot['boards'].items():
+            posts = [Post(**post) if version == 1 else Post(*post) for post in posts]
+            content[board] = {post.time: post for post in posts}
+        events = [PostEvent(kind, board, Post(*post), event_id=event_id)
+                  for event_id, kind, board, post in snapshot.get('events', [])]
+        return content, events
@@ -1,25 +1,58 @@
+import argparse
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from html import escape
+import json
 import logging
+import os
+import signal
 import textwrap
+import threading
 import time
-from typing import Dict
+from typing import Dict, Iterable, List, Optional, Tuple
 
-from feedgen.feed import FeedGenerator
 from pyramid.config import Configurator
-from pyramid.httpexceptions import HTTPNotFound, HTTPServiceUnavailable
+from pyramid.events import NewRequest, NewResponse
+from pyramid.httpexceptions import HTTPBadRequest, HTTPNotFound, HTTPServiceUnavailable
+from pyramid.renderers import render
 from pyramid.response import Response
 import pytz
 import toml
 from twitter.error import TwitterError
-from wsgiref.simple_server import make_server
-
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer
+
+from board_content import ContentGeneration, Post, RenderedPage, reuse_equal
+from events import diff_content, EventQueue, make_notifiers, PostEvent
+from metrics import count_cache_lookup, REGISTRY
+from feeds import FeedBuilder
+from scheduler import PollScheduler
+from search_index import SearchIndex
+from snapshot import SnapshotStore
 from muck_downloader import FakeMuckDownloader, MuckDownloader
 
 
 _TIME_FORMAT = "%Y-%m-%d %I:%M %p"
+_SEARCH_PAGE_SIZE = 20  # Search results per page.
+_MAX_PAGE_SIZE = 500  # The most posts a client can ask for on one page of a board.
+_SNAPSHOT_CHECK_INTERVAL = 1  # How often processes that don't download check for a new snapshot in seconds.
+_MAX_EVENTS_WAIT = 30  # The longest a long-polling client waits for events in seconds.
+_EVENT_STREAM_KEEPALIVE = 15  # How often to send something down an idle event stream in seconds.
+_EVENT_STREAM_DURATION = 300  # How long to keep an event stream open before the client has to reconnect.
+_EVENT_CLIENTS_RETRY_AFTER = 30  # How long to tell event clients to wait when we're serving too many, in seconds.
+
+_DOWNLOAD_SECONDS = REGISTRY.histogram('spindizzy_download_seconds',
+                                       "Time taken by each round of downloading and publishing boards.")
+_SNAPSHOT_LOAD_SECONDS = REGISTRY.histogram('spindizzy_snapshot_load_seconds',
+                                            "Time taken to load and publish each new snapshot.")
+_EVENT_CLIENTS_REJECTED = REGISTRY.counter('spindizzy_event_clients_rejected_total',
+                                           "Clients of /sdb/events turned away because max_clients were connected.")
+_DOWNLOAD_FAILURES = REGISTRY.counter('spindizzy_download_failures_total',
+                                      "Rounds of downloading boards that failed outright.")
+_REQUEST_SECONDS = REGISTRY.histogram('spindizzy_request_seconds',
+                                      "Time taken to answer requests to each route.", labels=('route',))
+_REQUESTS = REGISTRY.counter('spindizzy_requests_total', "Requests answered by route and status.",
+                             labels=('route', 'status'))
 
 
 class SpinDizzyBoards(object):
@@ -31,16 +64,25 @@ class SpinDizzyBoards(object):
 
     It also includes a background process that is responsible
     for keeping content up to date.
-     - Checks for new posts at a specified interval.
+     - Checks for new posts on each board, more often on busy boards
+       and less often on quiet ones or while the MUCK is unreachable.
      - Updates the state for the web-app.
-     - [Unimplemented] Sends out alerts to Twitter and Mastodon.
+     - Reports added, removed and edited posts to clients of
+       ``/sdb/events`` and to the configured notifiers.
+     - [Unimplemented] Notifiers for Twitter and Mastodon.
     """
-    def __init__(self, config: Dict):
+    def __init__(self, config: Dict, fetch: bool = True):
         """
         Args:
             config (dict): A parsed config.toml object.
+            fetch (bool): Whether to download content. If false, content is
+                read from ``snapshot_file`` whenever another process
+                that does download replaces it.
         """
-        if config['fake_muck']:
+        self.fetch = fetch
+        if not fetch:
+            self.downloader = None
+        elif config['fake_muck']:
             self.downloader = FakeMuckDownloader(**config['muck'])
         else:
             self.downloader = MuckDownloader(**config['muck'])
@@ -49,19 +91,52 @@ class SpinDizzyBoards(object):
         self.url_base = config['web']['url_base']
         self.tz = pytz.timezone(config['timezone'])
         self.feed_domain = config['web']['feed_domain']
+        self.feed_builder = FeedBuilder(board_names=self.board_names, tz=self.tz,
+                                        feed_domain=self.feed_domain,
+                                        max_entries=config['web'].get('feed_max_entries') or None)
+        self.posts_per_page = config['web'].get('posts_per_page', 50) or None
+        self.max_rendered_pages = config['web'].get('max_rendered_pages', 1000) or None
 
         # Will be filled in by a background thread.
-        self.current_content = {}
+        self.generation = ContentGeneration({}, 0)
         self.feeds = {}
+        self.search_index = SearchIndex()
+        notifications = config.get('notifications', {})
+        self.events = EventQueue(notifications.get('max_events', 1000))
+        # Each client of /sdb/events ties up a thread, so only serve a few at once.
+        self._event_clients = threading.BoundedSemaphore(notifications.get('max_clients', 8))
+        # Only the downloading process sends notifications so they aren't sent once per worker.
+        self.notifiers = make_notifiers(notifications.get('sinks', [])) if fetch else []
+
+        # Serve the content we saved last time until the first download finishes.
+        self.snapshots = SnapshotStore(config['snapshot_file']) if config.get('snapshot_file') else None
+        if self.snapshots is not None:
+            self._load_snapshot()
+        elif not fetch:
+            raise ValueError("snapshot_file must be set to serve content downloaded by another process.")
+        self._snapshot_watcher_pid = None  # The process the snapshot watcher thread was started in.
+        self._snapshot_watcher_lock = threading.Lock()
+        if not fetch:
+            self.start_snapshot_watcher()
 
         # Start up our background task.
         self.interval = config['interval']
-        self.executor = ThreadPoolExecutor(1)
-        self.loop = asyncio.get_event_loop()
-        self.download_task = asyncio.ensure_future(
-            self.loop.run_in_executor(self.executor, self.background_download))
-
-    def post2template(self, x):
+        self.scheduler = PollScheduler(self.boards, interval=self.interval,
+                                       min_interval=config.get('min_interval', self.interval),
+                                       max_interval=config.get('max_interval', self.interval),
+                                       max_backoff=config.get('max_backoff', self.interval))
+        if fetch:
+            self.executor = ThreadPoolExecutor(1)
+            self.loop = asyncio.get_event_loop()
+            self.download_task = asyncio.ensure_future(
+                self.loop.run_in_executor(self.executor, self.background_download))
+
+    @property
+    def current_content(self) -> Dict[str, Dict[int, Post]]:
+        """The posts on every board, keyed by board command and then post time."""
+        return self.generation.content
+
+    def post2template(self, x: Post):
         """
         This function does a little processing to turn the raw data
         associated with a post into the form a template expects.
@@ -72,14 +147,14 @@ class SpinDizzyBoards(object):
         *italic* and **bold** text) and any other similar things
         here, if desired.
         """
-        return { 'id': x['time'],
-                 'humantime': datetime.fromtimestamp(x['time'], self.tz).strftime(_TIME_FORMAT),
-                 'author_name': x['owner_name'],
-                 'title': x['title'],
-                 'content': x['content']
+        return { 'id': x.time,
+                 'humantime': datetime.fromtimestamp(x.time, self.tz).strftime(_TIME_FORMAT),
+                 'author_name': x.owner_name,
+                 'title': x.title,
+                 'content': x.content
                }
 
-    def _construct_feeds(self) -> Dict[str, Dict[str, str]]:
+    def _construct_feeds(self) -> Dict[str, RenderedPage]:
         """
         Takes the current content and returns a constructed dictionary
         of atom-formatted feeds. This method should only be
@@ -89,60 +164,12 @@ class SpinDizzyBoards(object):
                  command and one for ``master``. The values are
                  XML-formated feeds.
         """
-        def id_generator(name, ts):
-            return('tag:{feed_domain},{date}:{name}'
-                   .format(feed_domain=self.feed_domain,
-                           date=datetime.fromtimestamp(ts).strftime('%Y-%m-%d'),
-                           name=name))
-
-        def translate_content_to_xhtml(content):
-            """Try to render a board post as faithfully as possible in xhtml."""
-            # Unfortunately most readers I find strip the style attribute so we'll probably have to work on this.
-            return '<p style="white-space:pre-wrap;">{}</p>'.format(escape(content).replace('\n', '<br />'))
-
-        # TODO(hyena): It would be more useful if these links were absolute.
-        # Consider adding that if we ever make the web-app aware of its own
-        # url.
-
-        new_feeds = {}
-        master_feedgen = FeedGenerator()
-        master_feedgen.title("SpinDizzy Boards Master")
-        master_feedgen.link({'href': '/sdb/atom', 'rel': 'self'})
-        master_feedgen.description("All posts as scraped from SpinDizzy")
-        master_feedgen.id(id_generator('master', 0))
-
-        master_entry_list = []
-        for board_command in self.current_content:
-            board_feedgen = FeedGenerator()
-            board_feedgen.title("SpinDizzy {}".format(self.board_names[board_command]))
-            board_feedgen.link({'href': '/sdb/{}/atom'.format(board_command), 'rel': 'self'})
-            board_feedgen.description("Posts scraped from {}"
-                                      .format(self.board_names[board_command]))
-            board_feedgen.id(id_generator(board_command, 0))
-            for post in sorted(self.current_content[board_command].values(), key=lambda p: -p['time']):
-                entry = board_feedgen.add_entry()
-                entry.title(post['title'])
-                # RSS insists on an email which is annoying.
-                entry.author({'name': post['owner_name']})
-                entry.updated(datetime.fromtimestamp(post['time'], tz=self.tz))
-                entry.link({'href': '/sdb/{}/{}'.format(board_command, post['time']), 'rel': 'alternate'})
-                entry.content(translate_content_to_xhtml(post['content']), type='xhtml')
-                entry.id(id_generator(name='/sdb/{}/{}'.format(board_command, post['time']),
-                                      ts=post['time']))
-                master_entry_list.append(entry)
-            new_feeds[board_command] = board_feedgen.atom_str(pretty=True)
-
-        # Add the entries to the master feed in the right order.
-        for entry in sorted(master_entry_list, key=lambda e: -e.updated().timestamp()):
-            master_feedgen.add_entry(feedEntry=entry)
-        new_feeds['master'] = master_feedgen.atom_str(pretty=True)
-
-        return new_feeds
+        return self.feed_builder.build(self.generation)
 
     def command_for_post(self, board: str, post_id: int):
         """ Generate the muck side command to read a given postid, given present board contents."""
         # This assumes that the posts are sorted by time.
-        index = sorted(self.current_content[board].keys()).index(post_id) + 1
+        index = self.generation.indexes[board].position(post_id) + 1
         return "{} {}".format(board, index)
 
     def url_for_post(self, board: str, post_id: int):
@@ -150,99 +177,557 @@ class SpinDizzyBoards(object):
         url_base = self.url_base[:-1] if self.url_base.endswith('/') else self.url_base
         return "{}/sdb/{}/{}".format(url_base, board, post_id)
 
-    def background_download(self):
-        """Background task to download board content."""
-        # TODO(hyena): This isn't especially fault tolerant right now.
-        # If it dies in a recoverable fashion, we should log the error and retry.
-        # Conversely if it dies to a logical or fatal error, we should kill the
-        # the webserver too. Unfortunately right now if anything goes wrong, this
-        # thread dies quietly.
+    def _merge_updates(self, updates: Dict[str, Dict]) -> Dict[str, Dict[int, Post]]:
+        """
+        Applies the updates from ``MuckDownloader.get_updates`` to the current
+        content and returns the result. The current content isn't modified since
+        view callables may still be reading it.
+
+        Boards missing from ``updates`` are kept as they are.
+        """
+        new_content = dict(self.current_content)
+        for board_command, update in updates.items():
+            old_posts = self.current_content.get(board_command)
+            if old_posts is not None and not update['posts'] and update['ids'] == old_posts.keys():
+                continue  # Nothing changed.
+            old_posts = old_posts or {}
+            posts = {post_id: post for post_id, post in old_posts.items() if post_id in update['ids']}
+            posts.update(update['posts'])
+            # Posts sent again unchanged keep the copy we already have.
+            new_content[board_command] = reuse_equal(old_posts, posts)
+        return new_content
+
+    def _refresh_owner_names(self, content: Dict[str, Dict[int, Post]],
+                             boards: Iterable[str]) -> Dict[str, Dict[int, Post]]:
+        """
+        Looks up the owners of the posts on ``boards`` again and returns
+        ``content`` with the posts whose owner's name changed replaced.
+
+        Posts are only downloaded once, so this is what fixes a name that
+        couldn't be looked up at the time, or notices a character being
+        renamed once its name expires from the cache. Names that are still
+        cached aren't asked for again.
+        """
+        owners = {post.owner for board in boards for post in content.get(board, {}).values()}
+        try:
+            names = self.downloader.resolve_names(owners)
+        except Exception:
+            logging.warning("Couldn't look up the names of post owners again", exc_info=True)
+            return content
+        new_content = dict(content)
+        for board in boards:
+            posts = content.get(board, {})
+            renamed = {post_id: post.with_owner_name(names[post.owner]) for post_id, post in posts.items()
+                       if names.get(post.owner, post.owner_name) != post.owner_name}
+            if renamed:
+                new_content[board] = dict(posts)
+                new_content[board].update(renamed)
+        return new_content
+
+    def _publish(self, content: Dict[str, Dict[int, Post]],
+                 saved_events: Optional[List[PostEvent]] = None) -> List[PostEvent]:
+        """
+        Makes ``content`` the content served by the web app if it differs
+        from the current content. Only the background thread calls this.
+
+        Args:
+            content (dict): The posts to serve.
+            saved_events (list): The numbered events loaded along with
+                ``content`` from a snapshot. If not given, the events are
+                worked out by comparing ``content`` with the current content.
+
+        :return: The events that are new to ``events``. There are none
+                 worked out for the first content published.
+        """
+        old_content = self.current_content
+        unchanged = content.keys() == old_content.keys() and all(content[board] is old_content[board]
+                                                                 for board in content)
+        first = self.generation.number == 0
+        # If nothing changed there's no need to throw away our caches.
+        if not unchanged:
+            # Swapping in the new generation is atomic thanks to the GIL.
+            self.generation = ContentGeneration(content, self.generation.number + 1, previous=self.generation,
+                                                max_rendered=self.max_rendered_pages)
+            self.feeds = self._construct_feeds()
+            self.search_index.update(old_content, content)
+        if saved_events is not None:
+            return self.events.restore(saved_events)
+        events = [] if unchanged or first else diff_content(old_content, content)
+        self.events.put(events)
+        return events
+
+    def _notify(self, events: List[PostEvent]):
+        """Sends ``events`` to every notifier, carrying on if one of them fails."""
+        if not events:
+            return
+        for notifier in self.notifiers:
+            try:
+                notifier.notify(events)
+            except Exception:
+                logging.warning("Error while sending events to {}".format(type(notifier).__name__),
+                                exc_info=True)
+
+    def _reuse_unchanged(self, content: Dict[str, Dict[int, Post]]) -> Dict[str, Dict[int, Post]]:
+        """
+        Replaces boards and posts in ``content`` that are equal to ones in
+        the current content with the current objects. Our caches recognize
+        unchanged content by identity, so this keeps a reload from
+        rebuilding everything.
+        """
+        old_content = self.current_content
+        return {board: reuse_equal(old_content.get(board, {}), posts) for board, posts in content.items()}
+
+    def _load_snapshot(self):
+        """
+        Publishes the saved snapshot, if any, and downloads only what's changed since.
+        Events keep the ids they were saved with so they're the same in every process.
+        """
+        snapshot = self.snapshots.load()
+        if snapshot is None:
+            return
+        content, events = snapshot
+        content = {board: posts for board, posts in content.items() if board in self.board_names}
+        self._publish(self._reuse_unchanged(content), events)
+        logging.info("Loaded {count} posts from {path}"
+                     .format(count=sum(len(posts) for posts in content.values()), path=self.snapshots.path))
+
+    def start_snapshot_watcher(self):
+        """
+        Starts a thread that publishes the snapshot file whenever another
+        process replaces it, so requests carry on being served from the
+        current content while a new snapshot loads.
+
+        Does nothing if this process already has one. Threads don't survive
+        a fork, so this is called again on each request in case we're a
+        worker forked after the first one started, e.g. by `gunicorn --preload`.
+        """
+        if self._snapshot_watcher_pid == os.getpid():
+            return
+        with self._snapshot_watcher_lock:
+            if self._snapshot_watcher_pid != os.getpid():
+                threading.Thread(target=self.watch_snapshot, name='snapshot-watcher', daemon=True).start()
+                self._snapshot_watcher_pid = os.getpid()
+
+    def watch_snapshot(self):
+        """Background task to publish the snapshot file whenever it's replaced."""
         while True:
-            next_runtime = time.time() + self.interval
             try:
-                # Expose the downloaded content without waiting for sending announcements.
-                # The GIL makes this safe.
-                self.current_content = self.downloader.get_posts()
-                self.feeds = self._construct_feeds()
-            except:
-                # Optimistically continue.
-                logging.warn('Error while trying to retrieve boards', exc_info=True)
-            # New content gotten. Rest if we can....
-            sleep_length = next_runtime - time.time()
-            if sleep_length > 0:
-                time.sleep(sleep_length)
+                if self.snapshots.changed():
+                    with _SNAPSHOT_LOAD_SECONDS.time():
+                        self._load_snapshot()
+            except Exception:
+                # Keep serving what we have and try again next time.
+                logging.warning("Error while loading snapshot", exc_info=True)
+            time.sleep(_SNAPSHOT_CHECK_INTERVAL)
+
+    def background_download(self):
+        """Background task to download board content as ``scheduler`` says it's due."""
+        # TODO(hyena): If this dies to a logical or fatal error, we should kill
+        # the webserver too. Unfortunately right now if anything goes wrong
+        # outside of a download, this thread dies quietly.
+        while True:
+            boards = self.scheduler.due()
+            if boards:
+                with _DOWNLOAD_SECONDS.time():
+                    self._download_boards(boards)
+            self.scheduler.wait()
+
+    def _download_boards(self, boards: List[str]):
+        """Downloads and publishes the changes to ``boards`` and schedules their next downloads."""
+        old_content = self.current_content
+        updates = {}
+        try:
+            # Expose the downloaded content without waiting for sending announcements.
+            # The GIL makes this safe.
+            # Ask for what's newer than what we've published, so posts from a download
+            # that failed before it was published are asked for again next time.
+            since = {board: max(posts) for board, posts in old_content.items() if posts}
+            updates = self.downloader.get_updates(since, boards)
+            events = self._publish(self._refresh_owner_names(self._merge_updates(updates), updates))
+            if self.snapshots is not None and self.current_content is not old_content:
+                self.snapshots.save(self.current_content, self.events.recent())
+            self._notify(events)
+        except:
+            _DOWNLOAD_FAILURES.inc()
+            # Optimistically continue.
+            logging.warn('Error while trying to retrieve boards', exc_info=True)
+        for board in boards:
+            if board in updates:
+                new_posts = updates[board]['posts'].keys() - old_content.get(board, {}).keys()
+                self.scheduler.record_success(board, new_posts=len(new_posts))
+            else:
+                self.scheduler.record_failure(board)
+
+    def refresh_now(self):
+        """Downloads every board straight away instead of waiting until they're due."""
+        self.scheduler.refresh_now()
+
+    def _render_cached(self, generation: ContentGeneration, renderer_name: str, key, request, make_value,
+                       cache: bool = True):
+        """
+        Returns a response with ``renderer_name`` rendered, reusing the page
+        from ``generation`` if it's been rendered before.
+
+        Args:
+            key: Identifies the page among all of the ones using ``renderer_name``.
+            make_value: Called to make the value to render if the page isn't cached.
+            cache (bool): Whether to keep the page for next time. Pages that
+                only unusual requests ask for aren't worth keeping.
+        """
+        cache_key = (renderer_name, key)
+        page = generation.rendered.get(cache_key) if cache else None
+        if cache:
+            count_cache_lookup('page', hit=page is not None)
+        if page is None:
+            body = render(renderer_name, make_value(), request=request).encode('utf-8')
+            page = self._keep_last_modified(generation, cache_key,
+                                            RenderedPage(body, last_modified=generation.created))
+            if cache:
+                generation.rendered.put(cache_key, page)
+        return self._conditional_response(page)
+
+    @staticmethod
+    def _keep_last_modified(generation: ContentGeneration, cache_key, page: RenderedPage) -> RenderedPage:
+        """
+        Gives ``page`` the last modified time of the previous generation's
+        page under ``cache_key`` if it hasn't changed, so a change to one
+        board doesn't make clients download every other page again.
+        """
+        old_page = generation.previous_rendered.get(cache_key) if generation.previous_rendered else None
+        if old_page is not None and old_page.etag == page.etag:
+            page.last_modified = old_page.last_modified
+        return page
+
+    def _conditional_response(self, page: RenderedPage, content_type: str = 'text/html'):
+        """
+        Returns a response for ``page`` that answers ``If-None-Match`` and
+        ``If-Modified-Since`` requests with a 304 when the client is up to date.
+        """
+        response = Response(page.body, content_type=content_type, charset='UTF-8',
+                            conditional_response=True)
+        response.etag = page.etag
+        response.last_modified = page.last_modified
+        return response
+
+    @staticmethod
+    def _int_param(request, name: str) -> Optional[int]:
+        """Returns an integer query parameter or ``None`` if it wasn't given."""
+        value = request.params.get(name)
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise HTTPBadRequest("{} must be a number.".format(name))
 
     ### View Callables.
     def list_boards(self, request):
         """View callable that shows a list of available boards."""
-        loaded_boards = self.current_content.keys()
-        boards = [x for x in self.boards if x in loaded_boards]
-        return {'boards': boards,
-                'board_names': self.board_names,
-                }
+        generation = self.generation
+        def make_value():
+            loaded_boards = generation.content.keys()
+            boards = [x for x in self.boards if x in loaded_boards]
+            return {'boards': boards,
+                    'board_names': self.board_names,
+                    }
+        return self._render_cached(generation, "templates/boardlist.jinja2", None, request, make_value)
 
     def list_posts(self, request):
-        """View callable that shows all the posts on a particular board."""
+        """
+        View callable that shows the posts on a particular board a page at a time.
+
+        Shows the newest posts unless given a ``before`` or ``after`` post id to
+        page from. ``limit`` sets how many posts are on a page.
+        """
         # Grab this at the start because it might get updated in a background thread.
-        content = self.current_content
+        generation = self.generation
+        content = generation.content
         board = request.matchdict['board_command'].lower()
         if board not in content:
             raise HTTPNotFound("No such board found.")
-        return {'posts': [self.post2template(x)
-                          for x in sorted(content[board].values(), key=lambda p: p['time'])],
-                'board': board,
-                'board_name': self.board_names[board],
-               }
+        before = self._int_param(request, 'before')
+        after = self._int_param(request, 'after')
+        limit = self._int_param(request, 'limit')
+        if limit is not None:
+            limit = min(max(limit, 1), _MAX_PAGE_SIZE)
+        page_size = limit or self.posts_per_page
+
+        index = generation.indexes[board]
+        if after is not None:
+            start, end = index.newer_than(after, page_size)
+        else:
+            start, end = index.older_than(before, page_size)
+
+        def page_url(**params):
+            if limit is not None:
+                params['limit'] = limit
+            return request.route_path('posts_list', board_command=board, _query=params)
+
+        def make_value():
+            older_page = newer_page = None
+            if start > 0:
+                older_page = page_url(before=index.post_ids[start]) if start < len(index) else page_url()
+            if end < len(index):
+                newer_page = page_url(after=index.post_ids[end - 1] if end > 0 else index.post_ids[0] - 1)
+            return {'posts': [self.post2template(content[board][x])
+                              for x in index.post_ids[start:end]],
+                    'first_index': start + 1,
+                    'older_page': older_page,
+                    'newer_page': newer_page,
+                    'board': board,
+                    'board_name': self.board_names[board],
+                   }
+        # Only pages of the usual size are cached, so a client trying every limit can't fill the cache.
+        return self._render_cached(generation, "templates/postlist.jinja2", (board, start, end),
+                                   request, make_value, cache=limit is None)
 
     def view_post(self, request):
         """View callable that shows the contents of a post."""
         # Grab this at the start because it might be updated by the background thread.
-        content = self.current_content
+        generation = self.generation
+        content = generation.content
         board = request.matchdict['board_command'].lower()
         postid = int(request.matchdict['post_id'])
         if board not in content or postid not in content[board]:
             raise HTTPNotFound("Post not found")
-        post_ids = sorted(content[board].keys())
-        post_pos = post_ids.index(postid)
-        prev_post_id = content[board][post_ids[post_pos - 1]] if post_pos > 0 else None
-        next_post_id = content[board][post_ids[post_pos + 1]] if post_pos + 1 < len(post_ids) else None
-        return {'post': self.post2template(content[board][postid]),
-                'post_index': post_pos + 1,
-                'prev_post': self.post2template(prev_post_id) if prev_post_id is not None else None,
-                'next_post': self.post2template(next_post_id) if next_post_id is not None else None,
+        def make_value():
+            index = generation.indexes[board]
+            prev_post_id = index.previous(postid)
+            next_post_id = index.next(postid)
+            return {'post': self.post2template(content[board][postid]),
+                    'post_index': index.position(postid) + 1,
+                    'prev_post': self.post2template(content[board][prev_post_id]) if prev_post_id is not None else None,
+                    'next_post': self.post2template(content[board][next_post_id]) if next_post_id is not None else None,
+                    'board': board,
+                    'board_name': self.board_names[board],
+                   }
+        return self._render_cached(generation, "templates/post.jinja2", (board, postid), request, make_value)
+
+    def search(self, request):
+        """View callable that searches the posts on every board or just one."""
+        content = self.generation.content
+        query = request.params.get('q', '').strip()
+        board = request.params.get('board', '').lower() or None
+        if board is not None and board not in self.board_names:
+            raise HTTPNotFound("No such board found.")
+        try:
+            page = max(1, int(request.params.get('page', 1)))
+        except ValueError:
+            raise HTTPBadRequest("Invalid page number.")
+
+        offset = (page - 1) * _SEARCH_PAGE_SIZE
+        total, matches = self.search_index.search(query, board=board, offset=offset,
+                                                  limit=_SEARCH_PAGE_SIZE)
+        # The index may have been updated since we grabbed the content.
+        results = [{'board': match_board, 'post': self.post2template(content[match_board][post_id])}
+                   for match_board, post_id in matches
+                   if post_id in content.get(match_board, {})]
+
+        def page_url(page_number):
+            params = {'q': query, 'page': page_number}
+            if board is not None:
+                params['board'] = board
+            return request.route_path('search', _query=params)
+        return {'query': query,
                 'board': board,
-                'board_name': self.board_names[board],
+                'board_names': self.board_names,
+                'total': total,
+                'offset': offset,
+                'results': results,
+                'prev_page': page_url(page - 1) if page > 1 else None,
+                'next_page': page_url(page + 1) if offset + _SEARCH_PAGE_SIZE < total else None,
                }
 
+    def _wait_for_events(self, last_id: int, board: Optional[str],
+                         timeout: float) -> Tuple[int, List[PostEvent]]:
+        """
+        Waits up to ``timeout`` seconds for events newer than ``last_id``,
+        only counting ones for ``board`` if it's given.
+
+        :return: The id of the newest event looked at, to pass as ``last_id``
+                 next time, and the matching events.
+        """
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return last_id, []
+            events = self.events.since(last_id, timeout=remaining)
+            if events:
+                last_id = events[-1].id
+                events = [event for event in events if board is None or event.board == board]
+                if events:
+                    return last_id, events
+
+    def _event_dict(self, event: PostEvent) -> Dict:
+        return dict(event.to_dict(), url=self.url_for_post(event.board, event.post_id))
+
+    def _event_stream(self, last_id: int, board: Optional[str]):
+        """Yields Server-Sent Events until ``_EVENT_STREAM_DURATION`` has passed."""
+        # Ask clients to wait a little before reconnecting when we close the stream.
+        yield b"retry: 5000\n\n"
+        deadline = time.time() + _EVENT_STREAM_DURATION
+        while time.time() < deadline:
+            last_id, events = self._wait_for_events(last_id, board, _EVENT_STREAM_KEEPALIVE)
+            if not events:
+                yield b": keepalive\n\n"
+            for event in events:
+                yield "id: {id}\nevent: {kind}\ndata: {data}\n\n".format(
+                    id=event.id, kind=event.kind, data=json.dumps(self._event_dict(event))).encode('utf-8')
+
+    def _feed_response(self, feeds: Dict[str, RenderedPage], name: str, request):
+        """
+        Returns the feed for a board or ``master``, or the older page of it
+        asked for with ``before``.
+        """
+        before = self._int_param(request, 'before')
+        if before is None:
+            page = feeds[name]
+        else:
+            generation = self.generation
+            # Many values of before give the same page so cache it under just one of them.
+            before = self.feed_builder.canonical_before(generation, name, before)
+            cache_key = ('feed', name, before)
+            page = generation.rendered.get(cache_key)
+            count_cache_lookup('feed_page', hit=page is not None)
+            if page is None:
+                page = self._keep_last_modified(generation, cache_key,
+                                                self.feed_builder.page(generation, name, before))
+                generation.rendered.put(cache_key, page)
+        return self._conditional_response(page, content_type='application/atom+xml')
+
+    def post_events(self, request):
+        """
+        View callable that pushes post events to clients as they happen.
+
+        Clients that accept ``text/event-stream`` get a Server-Sent Events
+        stream. Others get JSON holding ``events`` and ``last_id`` once
+        there's at least one event or ``timeout`` seconds pass, and should
+        ask again with ``since`` set to ``last_id``. ``board`` limits the
+        events to one board.
+
+        Each client holds on to a thread while it waits, so once
+        ``max_clients`` are connected the rest are told to come back later.
+        """
+        board = request.params.get('board', '').lower() or None
+        if board is not None and board not in self.board_names:
+            raise HTTPNotFound("No such board found.")
+        since = self._int_param(request, 'since')
+        if since is None and request.headers.get('Last-Event-ID', '').isdigit():
+            since = int(request.headers['Last-Event-ID'])
+        if since is None:
+            last_id = self.events.last_id
+        elif self.snapshots is None:
+            # Without a snapshot ids start again after a restart, so one we haven't reached is from before it.
+            last_id = min(since, self.events.last_id)
+        else:
+            # Ids are kept in the snapshot, so one we haven't reached is from a process that's loaded a newer one.
+            last_id = since
+        timeout = self._int_param(request, 'timeout')
+        timeout = _MAX_EVENTS_WAIT if timeout is None else min(max(timeout, 0), _MAX_EVENTS_WAIT)
+
+        if not self._event_clients.acquire(blocking=False):
+            _EVENT_CLIENTS_REJECTED.inc()
+            raise HTTPServiceUnavailable("Too many clients are following events.",
+                                         headers={'Retry-After': str(_EVENT_CLIENTS_RETRY_AFTER)})
+
+        if 'text/event-stream' in request.headers.get('Accept', ''):
+            response = Response(content_type='text/event-stream', charset='UTF-8')
+            response.cache_control = 'no-cache'
+            # The server closes the stream when the client goes away, even if it's never read.
+            response.app_iter = _ClosingIterator(self._event_stream(last_id, board), self._event_clients.release)
+            return response
+
+        try:
+            last_id, events = self._wait_for_events(last_id, board, timeout)
+        finally:
+            self._event_clients.release()
+        response = Response(json.dumps({'last_id': last_id,
+                                        'events': [self._event_dict(event) for event in events]}),
+                            content_type='application/json', charset='UTF-8')
+        response.cache_control = 'no-cache'
+        return response
+
     def master_feed(self, request):
         """View callable that returns an atom feed for all boards."""
-        if not self.feeds:
+        feeds = self.feeds
+        if not feeds:
             # Tell the user to come back later.
             raise HTTPServiceUnavailable(headers={'Retry-After': '60'})
-        return Response(self.feeds['master'],
-                        content_type='application/atom+xml')
+        return self._feed_response(feeds, 'master', request)
 
     def board_feed(self, request):
         """View callable that returns an atom feed for a particular board."""
+        feeds = self.feeds
         board = request.matchdict['board_command'].lower()
         if board not in self.board_names:
             raise HTTPNotFound("No such board found.")
-        elif not self.feeds:
+        elif not feeds:
             # Tell the user to come back later.
             raise HTTPServiceUnavailable(headers={'Retry-After': '60'})
-        elif board not in self.feeds:
+        elif board not in feeds or board not in self.generation.content:
             raise HTTPNotFound("No such board found.")
-        return Response(self.feeds[board],
-                        content_type='application/atom+xml')
+        return self._feed_response(feeds, board, request)
 
 
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.DEBUG)
-    with open("config.toml") as config_file:
-        conf_toml = toml.loads(config_file.read())
-    worker = SpinDizzyBoards(conf_toml)
+class _ClosingIterator(object):
+    """
+    A WSGI response body that iterates over ``iterable`` and calls ``on_close``
+    once when the server closes it. A generator's own ``finally`` wouldn't run
+    if it were closed before it started.
+    """
+    def __init__(self, iterable, on_close):
+        self._iterator = iter(iterable)
+        self._on_close = on_close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._iterator)
 
-    # Set up webapp routes.
+    def close(self):
+        on_close, self._on_close = self._on_close, None
+        try:
+            if hasattr(self._iterator, 'close'):
+                self._iterator.close()
+        finally:
+            if on_close is not None:
+                on_close()
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """A wsgiref server that handles each request in its own thread."""
+    daemon_threads = True
+
+
+def metrics(request):
+    """View callable that reports this process's metrics in the Prometheus text format."""
+    return Response(REGISTRY.render(), content_type='text/plain', charset='UTF-8')
+
+
+def _start_timer(event):
+    event.request.start_time = time.perf_counter()
+
+
+def _record_request(event):
+    """Records how long a request took. Streamed responses are timed up to their first byte."""
+    request = event.request
+    route = request.matched_route.name if request.matched_route is not None else 'not_found'
+    _REQUEST_SECONDS.observe(time.perf_counter() - request.start_time, route=route)
+    _REQUESTS.inc(route=route, status=event.response.status_code)
+
+
+def make_metrics_app():
+    """Returns a web app that only serves ``/sdb/metrics``, for processes that don't serve anything else."""
+    config = Configurator()
+    config.add_route('metrics', '/sdb/metrics')
+    config.add_view(metrics, route_name='metrics')
+    return config.make_wsgi_app()
+
+
+def make_wsgi_app(worker: SpinDizzyBoards):
+    """Sets up the web app's routes for ``worker``'s view callables and returns it."""
     # Note that this could also be accomplished with pyramid's traversal functionality.
     # However, I think that for this usage case that adds more complexity than it's worth.
     config = Configurator()
@@ -253,24 +738,68 @@ if __name__ == "__main__":
         config.add_static_view(name='static', path='static')
 
         config.add_route('board_list', '/')
-        config.add_view(worker.list_boards, route_name='board_list', renderer="templates/boardlist.jinja2")
+        config.add_view(worker.list_boards, route_name='board_list')
 
-        # n.b. this must be registered before the /board_command route.
+        # n.b. this, search, events and metrics must be registered before the /board_command route.
         config.add_route('master_feed', '/atom')
         config.add_view(worker.master_feed, route_name='master_feed')
 
+        config.add_route('search', '/search')
+        config.add_view(worker.search, route_name='search', renderer="templates/search.jinja2")
+
+        config.add_route('post_events', '/events')
+        config.add_view(worker.post_events, route_name='post_events')
+
+        config.add_route('metrics', '/metrics')
+        config.add_view(metrics, route_name='metrics')
+
         config.add_route('posts_list', '/{board_command}')
-        config.add_view(worker.list_posts, route_name='posts_list', renderer="templates/postlist.jinja2")
+        config.add_view(worker.list_posts, route_name='posts_list')
 
         config.add_route('view_post', '/{board_command}/{post_id:\d+}')
-        config.add_view(worker.view_post, route_name='view_post', renderer="templates/post.jinja2")
+        config.add_view(worker.view_post, route_name='view_post')
 
         config.add_route('board_feed', '/{board_command}/atom')
         config.add_view(worker.board_feed, route_name='board_feed')
 
     config.include(setup_routes, route_prefix='sdb')
     config.add_notfound_view(lambda x: HTTPNotFound(), append_slash=True)
-    # TODO(hyena): Set up a *real* wsgi environment.
-    app = config.make_wsgi_app()
-    server = make_server('0.0.0.0', conf_toml['web']['port'], app)
-    server.serve_forever()
+    config.add_subscriber(_start_timer, NewRequest)
+    config.add_subscriber(_record_request, NewResponse)
+    if not worker.fetch:
+        # Pick up content downloaded by the fetching process.
+        config.add_subscriber(lambda event: worker.start_snapshot_watcher(), NewRequest)
+    return config.make_wsgi_app()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the contents of SpinDizzy's boards.")
+    parser.add_argument('--config', default='config.toml', help="The config file to use.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--fetch-only', action='store_true',
+                      help="Only download content into snapshot_file for web workers to serve.")
+    mode.add_argument('--serve-only', action='store_true',
+                      help="Only serve content from snapshot_file, downloaded by a --fetch-only process.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG)
+    with open(args.config) as config_file:
+        conf_toml = toml.loads(config_file.read())
+    if args.fetch_only and not conf_toml.get('snapshot_file'):
+        parser.error("--fetch-only needs snapshot_file to be set.")
+    worker = SpinDizzyBoards(conf_toml, fetch=not args.serve_only)
+
+    if not args.serve_only and hasattr(signal, 'SIGUSR1'):
+        # `kill -USR1 <pid>` to check for new posts now.
+        signal.signal(signal.SIGUSR1, lambda signum, frame: worker.refresh_now())
+
+    if args.fetch_only and conf_toml['web'].get('metrics_port'):
+        server = make_server('0.0.0.0', conf_toml['web']['metrics_port'], make_metrics_app(),
+                             server_class=_ThreadingWSGIServer)
+        server.serve_forever()
+    elif args.fetch_only:
+        worker.loop.run_until_complete(worker.download_task)
+    else:
+        app = make_wsgi_app(worker)
+        server = make_server('0.0.0.0', conf_toml['web']['port'], app, server_class=_ThreadingWSGIServer)
+        server.serve_forever()
@@ -0,0 +1,27 @@
+"""
+WSGI entry point for serving the web app with a production server
+such as gunicorn, e.g. from this directory:
+
+    gunicorn --workers 4 --worker-class gthread --threads 16 --bind 0.0.0.0:7000 wsgi:application
+
+Clients following ``/sdb/events`` hold on to a thread for minutes at a time,
+so use a threaded worker class like this rather than the default sync workers,
+and keep ``max_clients`` in ``[notifications]`` below the number of threads.
+
+The workers don't download anything themselves. They serve whatever a
+single ``python spindizzy_boards.py --fetch-only`` process last wrote to
+``snapshot_file``. The config file is read from ``$SPINDIZZY_BOARDS_CONFIG``,
+or ``config.toml`` if that isn't set.
+"""
+import logging
+import os
+
+import toml
+
+from spindizzy_boards import make_wsgi_app, SpinDizzyBoards
+
+
+logging.basicConfig(level=logging.INFO)
+with open(os.environ.get('SPINDIZZY_BOARDS_CONFIG', 'config.toml')) as config_file:
+    _conf = toml.loads(config_file.read())
+application = make_wsgi_app(SpinDizzyBoards(_conf, fetch=False))
@@ -0,0 +1,9 @@
+"""
+Tests for the web app and downloader. Run them from the top of the
+repository with `python -m unittest`.
+"""
+import os
+import sys
+
+# The modules import each other as top level modules, the way they're run.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'spindizzy_boards'))
@@ -0,0 +1,82 @@
+import threading
+import unittest
+
+from board_content import Post
+from events import ADDED, diff_content, EDITED, EventQueue, make_notifiers, MemoryNotifier, PostEvent, REMOVED
+
+
+def _post(post_id, title='Title', owner_name='Alice'):
+    return Post(time=post_id, owner='#1', owner_name=owner_name, title=title, content="Body\n")
+
+
+class DiffContentTest(unittest.TestCase):
+    def test_added_removed_and_edited(self):
+        old = {'+read': {1: _post(1), 2: _post(2), 3: _post(3)}}
+        new = {'+read': {1: old['+read'][1], 3: _post(3, title='Changed'), 4: _post(4)}}
+        events = diff_content(old, new)
+        self.assertEqual([(event.kind, event.post_id) for event in events],
+                         [(REMOVED, 2), (EDITED, 3), (ADDED, 4)])
+        self.assertEqual(events[0].post, old['+read'][2])
+
+    def test_equal_copies_are_not_edits(self):
+        old = {'+read': {1: _post(1)}}
+        self.assertEqual(diff_content(old, {'+read': {1: _post(1)}}), [])
+
+    def test_owner_name_looked_up_again_is_not_an_edit(self):
+        old = {'+read': {1: _post(1, owner_name='UNKNOWN')}}
+        self.assertEqual(diff_content(old, {'+read': {1: _post(1, owner_name='Alice')}}), [])
+
+    def test_new_boards_are_not_announced(self):
+        self.assertEqual(diff_content({}, {'+read': {1: _post(1)}}), [])
+
+
+class EventQueueTest(unittest.TestCase):
+    def test_numbers_events_from_diff(self):
+        queue = EventQueue()
+        old = {'+read': {1: _post(1)}}
+        queue.put(diff_content(old, {'+read': {1: _post(1), 2: _post(2)}}))
+        queue.put(diff_content(old, {'+read': {}}))
+        self.assertEqual([(event.id, event.kind) for event in queue.since(0)], [(1, ADDED), (2, REMOVED)])
+        self.assertEqual([event.id for event in queue.since(1)], [2])
+        self.assertEqual(queue.last_id, 2)
+
+    def test_drops_oldest_events(self):
+        queue = EventQueue(max_events=2)
+        queue.put([PostEvent(ADDED, '+read', _post(post_id)) for post_id in range(5)])
+        self.assertEqual([event.id for event in queue.since(0)], [4, 5])
+
+    def test_since_waits_for_events(self):
+        queue = EventQueue()
+        timer = threading.Timer(0.1, queue.put, [[PostEvent(ADDED, '+read', _post(1))]])
+        timer.start()
+        self.assertEqual([event.id for event in queue.since(0, timeout=5)], [1])
+        timer.join()
+
+    def test_since_times_out(self):
+        self.assertEqual(EventQueue().since(0, timeout=0.01), [])
+
+    def test_restore_keeps_ids(self):
+        fetcher = EventQueue()
+        fetcher.put([PostEvent(ADDED, '+read', _post(post_id)) for post_id in range(3)])
+        worker = EventQueue()
+        self.assertEqual([event.id for event in worker.restore(fetcher.recent()[:2])], [1, 2])
+        # Restoring a newer snapshot only adds the events we don't have yet.
+        self.assertEqual([event.id for event in worker.restore(fetcher.recent())], [3])
+        self.assertEqual(worker.last_id, 3)
+
+
+class NotifierTest(unittest.TestCase):
+    def test_make_notifiers(self):
+        notifiers = make_notifiers(['memory'])
+        event = PostEvent(ADDED, '+read', _post(1))
+        notifiers[0].notify([event])
+        self.assertIsInstance(notifiers[0], MemoryNotifier)
+        self.assertEqual(notifiers[0].events, [event])
+
+    def test_unknown_notifier(self):
+        with self.assertRaises(ValueError):
+            make_notifiers(['carrier pigeon'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+from unittest import mock
+import logging
+import time
+import unittest
+
+from fake_muck_server import FakeMuck, FakeMuckServer
+import muck_downloader
+from muck_downloader import MuckDownloader
+from name_cache import UNKNOWN_NAME
+
+
+_BOARDS = [['+read', 'General Board'], ['cread', 'Commands Board']]
+_READ_TIMEOUT = 0.3  # Short so the timeout tests are quick.
+
+
+class _SlowNamesMuck(FakeMuck):
+    """A fake MUCK that can be told to take too long answering name lookups."""
+    name_delay = 0
+
+    def getname(self, dbref):
+        time.sleep(self.name_delay)
+        return super().getname(dbref)
+
+    def getnames(self, dbrefs):
+        time.sleep(self.name_delay)
+        return super().getnames(dbrefs)
+
+
+class MuckDownloaderTest(unittest.TestCase):
+    batch_names = True
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        patcher = mock.patch.object(muck_downloader, '_MUCK_READ_TIMEOUT', _READ_TIMEOUT)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.muck = _SlowNamesMuck({'+read': 30, 'cread': 5}, dead_ref_rate=0.2)
+        self.server = FakeMuckServer(self.muck)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        host, port = self.server.address
+        self.downloader = MuckDownloader(host=host, port=port, ssl=False, character='test', password='test',
+                                         get_posts_command='process_posts', get_name_command='getname',
+                                         get_names_command='getnames' if self.batch_names else None,
+                                         boards=_BOARDS, board_timeout=30)
+        self.addCleanup(self.downloader.close)
+
+    def expected_name(self, dbref):
+        return self.muck.names.get(dbref, UNKNOWN_NAME)
+
+    def assertNamesMatch(self, posts):
+        for post in posts.values():
+            self.assertEqual(post.owner_name, self.expected_name(post.owner))
+
+    def test_full_sync(self):
+        content = self.downloader.get_posts()
+        self.assertEqual(content.keys(), {'+read', 'cread'})
+        for board, posts in content.items():
+            fake_posts = self.muck.boards[board]
+            self.assertEqual(posts.keys(), fake_posts.keys())
+            for post_id, post in posts.items():
+                self.assertEqual(post.title, fake_posts[post_id].title)
+                self.assertEqual(post.content, "".join(line + "\n" for line in fake_posts[post_id].content))
+            self.assertNamesMatch(posts)
+
+    def test_incremental_sync(self):
+        content = self.downloader.get_posts()
+        since = {board: max(posts) for board, posts in content.items()}
+        new_post = self.muck.add_post('+read')
+        updates = self.downloader.get_updates(since)
+        self.assertEqual(list(updates['+read']['posts']), [new_post.post_id])
+        self.assertEqual(updates['+read']['ids'], set(self.muck.boards['+read']))
+        self.assertEqual(updates['cread']['posts'], {})
+        self.assertEqual(updates['cread']['ids'], set(content['cread']))
+
+    def test_only_asked_boards(self):
+        updates = self.downloader.get_updates({}, boards=['cread'])
+        self.assertEqual(list(updates), ['cread'])
+
+    def test_deletions(self):
+        content = self.downloader.get_posts()
+        since = {board: max(posts) for board, posts in content.items()}
+        deleted = min(content['+read'])
+        self.muck.remove_post('+read', deleted)
+        updates = self.downloader.get_updates(since)
+        self.assertNotIn(deleted, updates['+read']['ids'])
+        self.assertEqual(updates['+read']['ids'], set(content['+read']) - {deleted})
+
+    def test_dead_dbrefs_are_unknown_and_cached(self):
+        content = self.downloader.get_posts()
+        dead = {post.owner for posts in content.values() for post in posts.values()
+                if post.owner not in self.muck.names}
+        self.assertTrue(dead, "The fake MUCK should have some dead dbrefs.")
+        for dbref in dead:
+            self.assertEqual(self.downloader.name_cache.get(dbref), UNKNOWN_NAME)
+        self.assertNamesMatch(content['+read'])
+
+    def test_timed_out_names_are_not_cached(self):
+        self.muck.name_delay = _READ_TIMEOUT * 3
+        content = self.downloader.get_posts()
+        self.assertEqual({post.owner_name for post in content['+read'].values()}, {UNKNOWN_NAME})
+        self.assertEqual(len(self.downloader.name_cache._entries), 0)
+        # Wait for the late replies so they don't hold up the next lookup.
+        time.sleep(self.muck.name_delay * 2)
+        self.muck.name_delay = 0
+        owners = {post.owner for post in content['+read'].values()}
+        names = self.downloader.resolve_names(owners)
+        self.assertEqual(names, {dbref: self.expected_name(dbref) for dbref in owners})
+
+    def test_resolve_names_uses_cache(self):
+        content = self.downloader.get_posts()
+        owners = {post.owner for post in content['+read'].values()}
+        self.muck.name_delay = _READ_TIMEOUT * 3  # Any lookup that reached the MUCK would time out.
+        names = self.downloader.resolve_names(owners)
+        self.assertEqual(names, {dbref: self.expected_name(dbref) for dbref in owners})
+
+    def test_unknown_board(self):
+        downloader = self.downloader
+        downloader.boards = ['nosuchboard']
+        with self.assertRaisesRegex(Exception, "Command not found"):
+            downloader.get_posts()
+
+
+class MuckDownloaderSingleNamesTest(MuckDownloaderTest):
+    """The same tests looking names up one at a time with ``get_name_command``."""
+    batch_names = False
+
+
+if __name__ == '__main__':
+    unittest.main()
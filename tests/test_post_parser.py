@@ -0,0 +1,60 @@
+import unittest
+
+from post_parser import parse_posts
+
+
+def _post_lines(post_id, owner='#1234', title='A title', content=('First line', 'Second line')):
+    return (["|owner: " + owner, "|time: {}".format(post_id), "|title: " + title,
+             "|length: {}".format(len(content)), "|content:"]
+            + ["|" + line for line in content])
+
+
+class ParsePostsTest(unittest.TestCase):
+    def test_parses_ids_and_posts(self):
+        lines = (["Welcome to the MUCK.", "--- START", "--- ID: 1", "--- ID: 2"]
+                 + _post_lines(2, title='Hello', content=('Hi', '', 'Bye')) + ["--- END", "Ignored"])
+        parsed = list(parse_posts(lines))
+        self.assertEqual(parsed[:2], [('id', 1), ('id', 2)])
+        kind, post = parsed[2]
+        self.assertEqual(kind, 'post')
+        self.assertEqual((post.time, post.owner, post.owner_name, post.title, post.content),
+                         (2, '#1234', None, 'Hello', "Hi\n\nBye\n"))
+        self.assertEqual(len(parsed), 3)
+
+    def test_empty_board(self):
+        self.assertEqual(list(parse_posts(["--- START", "--- END"])), [])
+
+    def test_error(self):
+        lines = ["--- START", "--- ERROR: Command not found or ambiguous."]
+        with self.assertRaisesRegex(Exception, "Command not found"):
+            list(parse_posts(lines))
+
+    def test_truncated_between_posts(self):
+        lines = ["--- START", "--- ID: 1"] + _post_lines(1)
+        with self.assertRaisesRegex(ValueError, "without --- END"):
+            list(parse_posts(lines))
+
+    def test_truncated_inside_post(self):
+        lines = ["--- START", "--- ID: 1"] + _post_lines(1)[:-1]
+        with self.assertRaisesRegex(ValueError, "ended while looking for"):
+            list(parse_posts(lines))
+
+    def test_posts_before_truncation_are_yielded(self):
+        parsed = []
+        with self.assertRaises(ValueError):
+            for item in parse_posts(["--- START"] + _post_lines(1) + _post_lines(2)[:3]):
+                parsed.append(item)
+        self.assertEqual([post.time for kind, post in parsed], [1])
+
+    def test_missing_field(self):
+        lines = ["--- START", "|owner: #1", "|title: No time"]
+        with self.assertRaisesRegex(ValueError, "Expected |time: prefix"):
+            list(parse_posts(lines))
+
+    def test_unexpected_line(self):
+        with self.assertRaisesRegex(Exception, "Unexpected line"):
+            list(parse_posts(["--- START", "Somebody pages you."]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+
+from scheduler import PollScheduler
+
+
+class PollSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = PollScheduler(['+read', 'cread'], interval=100, min_interval=10,
+                                       max_interval=1000, max_backoff=5000, jitter=0)
+
+    def test_every_board_due_at_start(self):
+        self.assertEqual(sorted(self.scheduler.due(now=0)), ['+read', 'cread'])
+
+    def test_busy_boards_speed_up_and_quiet_ones_slow_down(self):
+        self.scheduler.record_success('+read', new_posts=2, now=0)
+        self.scheduler.record_success('cread', new_posts=0, now=0)
+        self.assertEqual(self.scheduler.next_poll, {'+read': 50, 'cread': 150})
+        self.assertEqual(self.scheduler.due(now=60), ['+read'])
+
+    def test_intervals_stay_in_bounds(self):
+        for _ in range(20):
+            self.scheduler.record_success('+read', new_posts=1, now=0)
+            self.scheduler.record_success('cread', new_posts=0, now=0)
+        self.assertEqual(self.scheduler.intervals, {'+read': 10, 'cread': 1000})
+
+    def test_failures_back_off_exponentially_up_to_max_backoff(self):
+        delays = []
+        for _ in range(8):
+            self.scheduler.record_failure('+read', now=0)
+            delays.append(self.scheduler.next_poll['+read'])
+        self.assertEqual(delays, [200, 400, 800, 1600, 3200, 5000, 5000, 5000])
+
+    def test_success_resets_backoff(self):
+        self.scheduler.record_failure('+read', now=0)
+        self.scheduler.record_failure('+read', now=0)
+        self.scheduler.record_success('+read', new_posts=1, now=0)
+        self.scheduler.record_failure('+read', now=0)
+        self.assertEqual(self.scheduler.next_poll['+read'], 100)
+
+    def test_long_outage_does_not_overflow(self):
+        for _ in range(2000):
+            self.scheduler.record_failure('+read', now=0)
+        self.assertEqual(self.scheduler.next_poll['+read'], 5000)
+
+    def test_jitter_stays_within_bounds(self):
+        scheduler = PollScheduler(['+read'], interval=100, min_interval=100, max_interval=100,
+                                  max_backoff=100, jitter=0.1)
+        for _ in range(100):
+            scheduler.record_success('+read', new_posts=0, now=0)
+            self.assertTrue(90 <= scheduler.next_poll['+read'] <= 110)
+
+    def test_refresh_now(self):
+        self.scheduler.due(now=0)
+        self.scheduler.record_success('+read', new_posts=0, now=0)
+        self.scheduler.record_success('cread', new_posts=0, now=0)
+        self.assertEqual(self.scheduler.due(now=1), [])
+        self.scheduler.refresh_now()
+        self.assertEqual(sorted(self.scheduler.due(now=1)), ['+read', 'cread'])
+
+    def test_refresh_now_during_download_is_kept(self):
+        boards = self.scheduler.due(now=0)
+        self.scheduler.refresh_now()  # e.g. SIGUSR1 while the boards are downloading.
+        self.scheduler.record_success('+read', new_posts=0, now=1)
+        self.scheduler.record_failure('cread', now=1)
+        self.assertEqual(sorted(self.scheduler.due(now=1)), sorted(boards))
+        # Once they've been downloaded again they're back on their schedules.
+        self.scheduler.record_success('+read', new_posts=0, now=2)
+        self.scheduler.record_success('cread', new_posts=0, now=2)
+        self.assertEqual(self.scheduler.due(now=2), [])
+
+    def test_refresh_now_wakes_wait(self):
+        self.scheduler.record_success('+read', new_posts=0, now=10 ** 12)
+        self.scheduler.record_success('cread', new_posts=0, now=10 ** 12)
+        self.scheduler.refresh_now()
+        self.scheduler.wait()  # Returns straight away instead of sleeping until the boards are due.
+
+
+if __name__ == '__main__':
+    unittest.main()